@@ -1,6 +1,7 @@
 import json
 import random
-from utils import Action, Settings
+from qtable import QTable, load
+from utils import Action
 
 
 class Agent:
@@ -12,31 +13,45 @@ class Agent:
     avoiding red apples and walls.
 
     Attributes:
-        qtable (dict): A dictionary mapping states to their Q-values.
+        qtable (QTable): Q-values of the view strings, addressed by their
+            interned integer IDs.
         lr (float): Learning rate for Q-learning updates.
         df (float): Discount factor for future rewards.
+        count_visits (bool): Whether `select_action` counts the visits of
+            the views it looks up in `qtable.visits`.
+        random (random.Random): Source of exploration and tie-breaks, e.g.
+            from `game_rng`; the `random` module by default.
+        random_picks (int): Number of decisions that depended on `random`.
 
     Methods:
+        encode(view: dict, learn: bool) -> dict:
+            Maps the view strings of a state to their Q-table IDs.
         select_action(state: dict, exploitation_rate: float) -> Action:
             Selects the next move based on exploration or exploitation.
+        count_visit(state: dict) -> None:
+            Counts a decision taken on the views of a state.
         update_q_table(state: dict, new_state: dict | None, action: Action,
                 reward: int) -> None:
             Updated Q-values according to Bellman equation.
-        _initiate_state_weights(states: dict) -> None:
-            Ensures Q-values are initialized for all states.
     """
     def __init__(self) -> None:
-        self.qtable = dict()
+        self.qtable = QTable()
         self.lr = 0.05
         self.df = 0.9
+        self.count_visits = False
+        self.random = random
+        self.random_picks = 0
 
-    def select_action(self, state: dict, exploitation_rate: float) -> Action:
+    def encode(self, view: dict, learn: bool = False) -> dict:
         """
-        Selects the direction of the snake's next move based on a balance of
-        exploration and exploitation.
+        Maps the view strings of a state to their IDs in the Q-table.
+
+        When learning, views that are not in the Q-table yet are added with
+        a value of 0, as every state the snake acts on gets a Q-value.
+        Otherwise unknown views get the ID -1 and are ignored by the agent.
 
         Args:
-            state (dict): A dictionary where:
+            view (dict): A dictionary where:
                 - Keys are directions from the `Action` enum (e.g., Action.UP,
                     Action.DOWN, etc.).
                 - Values are strings describing what the snake sees in each
@@ -53,6 +68,27 @@ class Agent:
                         Action.LEFT: "G0SW",
                         Action.RIGHT: "0R0W"
                     }
+            learn (bool): Whether unknown views are added to the Q-table.
+
+        Returns:
+            dict: A dictionary mapping each direction (Action) to the ID of
+                the corresponding view string.
+        """
+        if learn:
+            intern = self.qtable.intern
+            return {a: intern(s) for a, s in view.items()}
+        get_id = self.qtable.get_id
+        return {a: get_id(s) for a, s in view.items()}
+
+    def select_action(self, state: dict, exploitation_rate: float) -> Action:
+        """
+        Selects the direction of the snake's next move based on a balance of
+        exploration and exploitation.
+
+        Args:
+            state (dict): A dictionary mapping each direction (Action) to the
+                Q-table ID of what the snake sees in that direction, as
+                returned by `encode`; -1 for views not in the Q-table.
             exploitation_rate (float): The probability of choosing the best
                 known action (exploitation) versus a random action
                 (exploration).
@@ -60,20 +96,38 @@ class Agent:
         Returns:
             Action: The selected direction of the move.
         """
-        if Settings.visual and Settings.step_by_step:
-            self._print_snake_view(state)
-        explore = random.choices([True, False],
-                                 [1 - exploitation_rate, exploitation_rate])[0]
-        if not Settings.dontlearn:
-            self._initiate_state_weights(state)
+        if self.count_visits:
+            self.count_visit(state)
+        explore = self.random.choices(
+            [True, False], [1 - exploitation_rate, exploitation_rate])[0]
         if explore:
-            return random.choice([a for a in Action])
-        action_weights = {a: int(self.qtable[s]) for a, s in state.items()
-                          if s in self.qtable}
+            self.random_picks += 1
+            return self.random.choice([a for a in Action])
+        values = self.qtable.values
+        action_weights = {a: int(values[i]) for a, i in state.items()
+                          if i >= 0}
+        if not action_weights:
+            self.random_picks += 1
+            return self.random.choice([a for a in Action])
         max_value = max(action_weights.values())
         max_actions = [a for a, weight in action_weights.items()
                        if weight == max_value]
-        return random.choice(max_actions)
+        if len(max_actions) > 1:
+            self.random_picks += 1
+        return self.random.choice(max_actions)
+
+    def count_visit(self, state: dict) -> None:
+        """
+        Counts a decision taken on the views of a state.
+
+        Args:
+            state (dict): A dictionary mapping each direction (Action) to the
+                Q-table ID of its view, -1 for views not in the Q-table.
+        """
+        visits = self.qtable.visits
+        for i in state.values():
+            if i >= 0:
+                visits[i] += 1
 
     def update_q_table(self, state: dict, new_state: dict | None,
                        action: Action, reward: int) -> None:
@@ -83,10 +137,11 @@ class Agent:
 
         Args:
             state (dict): A dictionary mapping each direction (Action) to the
-                corresponding state string.
+                Q-table ID of the corresponding state string.
             new_state (dict or None): 4 directions of the next snake state
-                with corresponding views according to selected action; None if
-                that was the final step and game ends here.
+                with the IDs of the corresponding views according to selected
+                action, -1 for views not in the Q-table; None if that was the
+                final step and game ends here.
             action (Action): Selected action for the current snake state.
             reward (int): Reward obtained after moving the snake to the
                 next state.
@@ -94,70 +149,57 @@ class Agent:
         Returns:
             None
         """
+        values = self.qtable.values
         if new_state:
-            maxQ_next = max([self.qtable[s] for s in new_state.values()
-                             if s in self.qtable] or [0])
+            maxQ_next = max([values[i] for i in new_state.values()
+                             if i >= 0] or [0])
         else:
             maxQ_next = 0
-        self.qtable[state[action]] = self.qtable[state[action]] + self.lr * (
-            reward + self.df * maxQ_next - self.qtable[state[action]])
+        i = state[action]
+        values[i] = values[i] + self.lr * (
+            reward + self.df * maxQ_next - values[i])
 
-    def save_q_table(self, path: str) -> None:
+    def save_q_table(self, path: str, indent: int | None = None) -> None:
         """
         Saves the Q-table to a file.
 
         Args:
             path (str): The path to the file where the Q-table will be saved.
+            indent (int | None): Indentation of a pretty-printed export;
+                the JSON is compact by default.
 
         Returns:
             None
         """
         try:
-            q_table = self.qtable.copy()
+            q_table = self.qtable.to_dict()
             with open(path, 'w') as f:
-                json.dump(q_table, f, indent=4)
+                json.dump(q_table, f, indent=indent)
         except Exception as e:
             print(f'Error saving Q-table: {e}')
 
-    def load_q_table(self, path: str) -> None:
+    def load_q_table(self, path: str, read_only: bool = False) -> None:
         """
-        Loads the Q-table from a file.
+        Loads the Q-table from a file: a JSON model, a binary one (see
+        `qtable.save_binary`) or a delta (see `qtable.iter_delta`); the
+        format is detected from the file.
 
         Args:
             path (str): The path to the file where the Q-table is saved.
+            read_only (bool): If True, a binary model is memory-mapped and
+                looked up lazily instead of being read into memory; the
+                Q-table can't be updated then.
 
         Returns:
             None
         """
         try:
-            with open(path, 'r') as f:
-                self.qtable = json.load(f)
+            self.qtable = load(path, read_only)
         except Exception as e:
             print(f'Error loading Q-table: {e}')
             exit(1)
 
-    def _initiate_state_weights(self, state: dict) -> None:
-        """
-        Initializes Q-values for the snake's current state in all
-        possible directions.
-
-        This function ensures that each string, representing the snake's view
-        in a specific direction, has an initial Q-value in the Q-table. If
-        a view string does not already exist in the Q-table, it is initialized
-        with a value of 0.
-
-        Args:
-            state (dict): A dictionary mapping each direction (Action) to the
-                corresponding state string.
-
-        Returns:
-            None
-        """
-        for s in state.values():
-            if s not in self.qtable:
-                self.qtable[s] = 0
-
-    def _print_snake_view(self, state: dict) -> None:
+    def print_snake_view(self, state: dict) -> None:
         """
         Prints the snake's view in all possible directions.
 
@@ -189,3 +231,80 @@ class Agent:
                     print(' ', end=' ')
             print()
         print()
+
+
+class ValueCache(dict):
+    """
+    Maps view strings to their Q-values truncated to integers, as
+    `Agent.select_action` compares them, or None for views that are not in
+    the Q-table; every view is looked up in the table the first time only.
+    """
+    def __init__(self, qtable) -> None:
+        super().__init__()
+        self.qtable = qtable
+
+    def __missing__(self, key: str) -> float | None:
+        i = self.qtable.get_id(key)
+        value = self[key] = int(self.qtable.values[i]) if i >= 0 else None
+        return value
+
+
+class GreedyAgent(Agent):
+    """
+    An agent that plays a frozen model and always exploits.
+
+    States are encoded straight to the Q-values of their views through a
+    `ValueCache`, so a step costs one dictionary lookup per direction and
+    a single pass over the four values to pick the best one. The policy is
+    the one of `Agent.select_action` with an exploitation rate of 1, ties
+    of the truncated values included: comparing exact values makes the
+    snake loop much more often. But no exploration is drawn from `random`, so
+    the tie-breaks differ from those of an `Agent` with the same seed.
+
+    The Q-table must not be updated; replacing it resets the cache.
+    """
+    @property
+    def qtable(self):
+        return self._qtable
+
+    @qtable.setter
+    def qtable(self, qtable) -> None:
+        self._qtable = qtable
+        self.values = ValueCache(qtable)
+
+    def encode(self, view: dict, learn: bool = False) -> dict:
+        """
+        Maps the view strings of a state to their truncated Q-values, None
+        for views that are not in the Q-table.
+        """
+        values = self.values
+        return {a: values[s] for a, s in view.items()}
+
+    def select_action(self, state: dict, exploitation_rate: float = 1
+                      ) -> Action:
+        """
+        Selects the direction with the highest truncated Q-value, at random
+        among equal ones or when no view is known.
+
+        Args:
+            state (dict): A dictionary mapping each direction (Action) to the
+                truncated Q-value of its view, as returned by `encode`.
+            exploitation_rate (float): Ignored; the agent always exploits.
+
+        Returns:
+            Action: The selected direction of the move.
+        """
+        best = None
+        actions = []
+        for a, value in state.items():
+            if value is None:
+                continue
+            if best is None or value > best:
+                best = value
+                actions = [a]
+            elif value == best:
+                actions.append(a)
+        if len(actions) == 1:
+            return actions[0]
+        self.random_picks += 1
+        return self.random.choice(actions or list(Action))
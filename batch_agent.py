@@ -0,0 +1,146 @@
+import numpy as np
+
+from agent import Agent
+from utils import Action, game_rng
+
+# Column of every `Action.value` in the (N games x 4 directions) arrays of
+# state IDs, which follow the order of `Action`.
+COLUMNS = np.zeros(max(a.value for a in Action) + 1, dtype=np.intp)
+COLUMNS[[a.value for a in Action]] = np.arange(len(Action))
+ACTION_VALUES = np.array([a.value for a in Action])
+
+
+def game_generator(seed, stream: str, game: int) -> np.random.Generator:
+    """
+    Returns the NumPy generator of one component for one game, seeded from
+    the stream `game_rng` returns for the same arguments.
+    """
+    return np.random.default_rng(game_rng(seed, stream, game).getrandbits(64))
+
+
+class BatchAgent(Agent):
+    """
+    An agent that also selects actions for and learns from many games at
+    once, e.g. the games of a `BatchEnvironment`.
+
+    States are arrays of Q-table IDs of shape (N games, 4 directions), the
+    directions in the order of `Action` and -1 for unknown views, as
+    `encode` would return them for every game. The Q-values are gathered
+    from a NumPy view of `qtable.values`, and every random choice comes
+    from `rng`, so a batch run is reproducible from its seed.
+
+    Attributes:
+        rng (np.random.Generator): Source of exploration and tie-breaks of
+            the batch methods; `select_action` draws from `random`, as in
+            `Agent`.
+
+    Methods:
+        encode_batch(views: list, learn: bool) -> np.ndarray:
+            Maps the views of N states to an (N, 4) array of IDs.
+        select_actions(states: np.ndarray, exploitation_rate: float)
+                -> np.ndarray:
+            Selects the next move of every game.
+        update_q_tables(states: np.ndarray, next_states: np.ndarray | None,
+                actions: np.ndarray, rewards: np.ndarray, done: np.ndarray |
+                None, weights: np.ndarray | None) -> np.ndarray:
+            Applies the Bellman updates of N transitions.
+    """
+    def __init__(self, seed: int | None = None) -> None:
+        super().__init__()
+        self.rng = np.random.default_rng(seed)
+
+    def encode_batch(self, views: list, learn: bool = False) -> np.ndarray:
+        """
+        Maps the views of several states to their Q-table IDs.
+
+        Args:
+            views (list[dict]): The view of every game, as for `encode`.
+            learn (bool): Whether unknown views are added to the Q-table.
+
+        Returns:
+            np.ndarray: IDs of shape (N, 4), -1 for unknown views.
+        """
+        ids = np.empty((len(views), len(Action)), dtype=np.intp)
+        for row, view in zip(ids, views):
+            state = self.encode(view, learn)
+            row[:] = [state[a] for a in Action]
+        return ids
+
+    def select_actions(self, states: np.ndarray, exploitation_rate: float
+                       ) -> np.ndarray:
+        """
+        Selects the direction of the next move of every game, the way
+        `select_action` does: a random direction with probability
+        1 - `exploitation_rate`, otherwise one of the directions with the
+        highest Q-value truncated to an integer, at random among equal ones
+        or among all directions when no view is known.
+
+        Args:
+            states (np.ndarray): IDs of shape (N, 4).
+            exploitation_rate (float): The probability of exploiting.
+
+        Returns:
+            np.ndarray: The `Action.value` of the move of every game.
+        """
+        states = np.asarray(states)
+        n = len(states)
+        known = states >= 0
+        weights = np.trunc(np.frombuffer(self.qtable.values)[
+            np.where(known, states, 0)])
+        weights[~known] = -np.inf
+        best = weights == weights.max(axis=1, keepdims=True)
+        # Exploring and knowing no view both mean any direction will do.
+        explore = self.rng.random(n) >= exploitation_rate
+        best[explore | ~known.any(axis=1)] = True
+        scores = np.where(best, self.rng.random(best.shape), -1)
+        return ACTION_VALUES[scores.argmax(axis=1)]
+
+    def update_q_tables(self, states: np.ndarray,
+                        next_states: np.ndarray | None,
+                        actions: np.ndarray, rewards: np.ndarray,
+                        done: np.ndarray | None = None,
+                        weights: np.ndarray | None = None) -> np.ndarray:
+        """
+        Applies the Bellman updates of a batch of transitions.
+
+        All targets are computed from the Q-values before the batch, and
+        the changes are added with `np.add.at`, so when several transitions
+        update the same view their changes add up, whatever their order.
+        To first order in the learning rate this is the same as applying
+        them one after another with `update_q_table`.
+
+        Args:
+            states (np.ndarray): IDs of the states acted on, shape (N, 4);
+                all of them must be in the Q-table.
+            next_states (np.ndarray | None): IDs of the next states, shape
+                (N, 4), -1 for unknown views; None if every game ended.
+            actions (np.ndarray): `Action.value` of the moves made.
+            rewards (np.ndarray): Rewards of the moves.
+            done (np.ndarray | None): Mask of the games that ended with the
+                move, which have no next state.
+            weights (np.ndarray | None): Factors of the learning rate of
+                every transition, e.g. importance-sampling weights.
+
+        Returns:
+            np.ndarray: The TD error of every transition.
+        """
+        states = np.asarray(states)
+        values = np.frombuffer(self.qtable.values)
+        n = len(states)
+        max_next = np.zeros(n)
+        if next_states is not None:
+            next_states = np.asarray(next_states)
+            known = next_states >= 0
+            if done is not None:
+                known &= ~np.asarray(done)[:, None]
+            next_values = np.where(
+                known, values[np.where(known, next_states, 0)], -np.inf)
+            max_next = next_values.max(axis=1)
+            max_next[~known.any(axis=1)] = 0
+        keys = states[np.arange(n), COLUMNS[np.asarray(actions)]]
+        errors = np.asarray(rewards) + self.df * max_next - values[keys]
+        changes = self.lr * errors
+        if weights is not None:
+            changes *= weights
+        np.add.at(values, keys, changes)
+        return errors
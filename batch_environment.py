@@ -0,0 +1,229 @@
+from collections import namedtuple
+
+import numpy as np
+
+from utils import Action, LIMIT_DURATION
+
+# Cell codes used in the uint8 board tensor. LETTERS maps them back to the
+# one-character strings used by `Environment.state`.
+EMPTY, WALL, SNAKE, HEAD, GREEN, RED = range(6)
+LETTERS = np.array(['0', 'W', 'S', 'H', 'G', 'R'])
+
+BatchStep = namedtuple('BatchStep', ['cells', 'done', 'won', 'broken',
+                                     'length', 'duration'])
+
+
+class BatchEnvironment:
+    """
+    N snake games stepped in lockstep on a single NumPy board tensor.
+
+    The boards are stored as one `uint8` array of shape
+    (n, env_size, env_size) holding the cell codes defined above. Every
+    snake lives in a ring buffer of flat cell indices: the head is at
+    `head[i]` and the body follows it for `length[i]` slots, so a move only
+    writes the new head slot and advances the tail instead of shifting the
+    whole list. The rules are the ones of `Environment.move`; finished games
+    are reset in place at the end of the call that finished them.
+
+    Attributes:
+        n (int): Number of games.
+        size (int): Side of each board including walls.
+        state (np.ndarray): Board tensor of shape (n, size, size).
+        body (np.ndarray): Ring buffers of shape (n, size * size).
+        head (np.ndarray): Ring index of the head of every snake.
+        length (np.ndarray): Length of every snake.
+        duration (np.ndarray): Number of moves made in the current game.
+        rng (np.random.Generator): Source of every random placement.
+
+    Methods:
+        move(actions: np.ndarray) -> BatchStep:
+            Moves every snake one cell and resets the finished games.
+        reset(games: np.ndarray | None) -> None:
+            Starts new games on the given boards.
+        board(i: int) -> list:
+            Returns board `i` as a list of lists of letters.
+        snake(i: int) -> list[tuple]:
+            Returns the (x, y) cells of snake `i` from head to tail.
+    """
+    def __init__(self, n: int, env_size: int, seed: int | None = None
+                 ) -> None:
+        self.n = n
+        self.size = env_size
+        cells = self.size * self.size
+        self.rng = np.random.default_rng(seed)
+        self.template = np.full((self.size, self.size), WALL, dtype=np.uint8)
+        self.template[1:-1, 1:-1] = EMPTY
+        self.state = np.empty((n, self.size, self.size), dtype=np.uint8)
+        self.flat = self.state.reshape(n, cells)
+        self.body = np.zeros((n, cells), dtype=np.int32)
+        self.head = np.zeros(n, dtype=np.int32)
+        self.length = np.zeros(n, dtype=np.int32)
+        self.duration = np.zeros(n, dtype=np.int32)
+        # Flat index offsets indexed by `Action.value`.
+        self.offsets = np.zeros(max(a.value for a in Action) + 1,
+                                dtype=np.int32)
+        self.offsets[Action.UP.value] = -self.size
+        self.offsets[Action.DOWN.value] = self.size
+        self.offsets[Action.LEFT.value] = -1
+        self.offsets[Action.RIGHT.value] = 1
+        self.reset()
+
+    def move(self, actions: np.ndarray) -> BatchStep:
+        """
+        Moves the head of every snake one cell in the given direction and
+        adjusts the boards the same way `Environment.move` does.
+
+        Args:
+            actions (np.ndarray): `Action.value` of the move for every game.
+
+        Returns:
+            BatchStep: Codes of the cells the heads landed on, masks of the
+                games that ended (lost, won or broken by `LIMIT_DURATION`)
+                and their final lengths and durations. Ended games are
+                already reset when this returns.
+        """
+        rows = np.arange(self.n)
+        cap = self.body.shape[1]
+        new = (self.body[rows, self.head]
+               + self.offsets[np.asarray(actions)])
+        cells = self.flat[rows, new]
+
+        lost = ((cells == WALL) | (cells == SNAKE)
+                | ((cells == RED) & (self.length == 1)))
+        alive = ~lost
+        red = alive & (cells == RED)
+        green = alive & (cells == GREEN)
+
+        self._pop_tail(np.flatnonzero(alive & ((cells == EMPTY) | red)))
+        self._pop_tail(np.flatnonzero(red))
+        won = np.zeros(self.n, dtype=bool)
+        won[self._spawn(np.flatnonzero(red), RED)] = True
+        won[self._spawn(np.flatnonzero(green), GREEN)] = True
+
+        grow = np.flatnonzero(alive)
+        neck = grow[self.length[grow] > 0]
+        self.flat[neck, self.body[neck, self.head[neck]]] = SNAKE
+        self.head[grow] = (self.head[grow] - 1) % cap
+        self.body[grow, self.head[grow]] = new[grow]
+        self.flat[grow, new[grow]] = HEAD
+        self.length[grow] += 1
+
+        self.duration += 1
+        broken = alive & ~won & (self.duration > LIMIT_DURATION)
+        done = lost | won | broken
+        result = BatchStep(cells, done, won, broken,
+                           self.length.copy(), self.duration.copy())
+        self.reset(np.flatnonzero(done))
+        return result
+
+    def reset(self, games: np.ndarray | None = None) -> None:
+        """
+        Starts new games: restores the wall template, places a snake of
+        three cells and two green and one red apple.
+
+        Args:
+            games (np.ndarray | None): Indices of the games to reset; all
+                games when None.
+        """
+        games = np.arange(self.n) if games is None else np.asarray(games)
+        if not games.size:
+            return
+        self.state[games] = self.template
+        self.head[games] = 0
+        self.length[games] = 1
+        self.duration[games] = 0
+
+        head = self._pick_empty(games)
+        self.body[games, 0] = head
+        self.flat[games, head] = HEAD
+        for segment in range(1, 3):
+            position = self.body[games, segment - 1]
+            pending = np.arange(games.size)
+            while pending.size:
+                step = self.offsets[self.rng.integers(
+                    Action.UP.value, Action.RIGHT.value + 1, pending.size)]
+                cell = position[pending] + step
+                ok = self.flat[games[pending], cell] == EMPTY
+                placed = pending[ok]
+                self.body[games[placed], segment] = cell[ok]
+                self.flat[games[placed], cell[ok]] = SNAKE
+                pending = pending[~ok]
+        self.length[games] = 3
+
+        for color in (GREEN, GREEN, RED):
+            self._spawn(games, color)
+
+    def board(self, i: int) -> list:
+        """
+        Returns board `i` in the format of `Environment.state`.
+
+        Args:
+            i (int): Index of the game.
+
+        Returns:
+            list: Rows of one-character cell strings.
+        """
+        return LETTERS[self.state[i]].tolist()
+
+    def snake(self, i: int) -> list[tuple]:
+        """
+        Returns the cells of snake `i` from head to tail.
+
+        Args:
+            i (int): Index of the game.
+
+        Returns:
+            list[tuple]: (x, y) coordinates of the snake.
+        """
+        slots = (self.head[i] + np.arange(self.length[i])) % self.body.shape[1]
+        return [(int(c % self.size), int(c // self.size))
+                for c in self.body[i, slots]]
+
+    def _pop_tail(self, games: np.ndarray) -> None:
+        """
+        Removes the last cell of the given snakes.
+
+        Args:
+            games (np.ndarray): Indices of the games.
+        """
+        if not games.size:
+            return
+        tail = (self.head[games] + self.length[games] - 1) % self.body.shape[1]
+        self.flat[games, self.body[games, tail]] = EMPTY
+        self.length[games] -= 1
+
+    def _pick_empty(self, games: np.ndarray) -> np.ndarray:
+        """
+        Picks a uniformly random empty cell on each of the given boards.
+
+        Args:
+            games (np.ndarray): Indices of the games.
+
+        Returns:
+            np.ndarray: Flat cell index per game, -1 for full boards.
+        """
+        empty = self.flat[games] == EMPTY
+        scores = self.rng.random(empty.shape)
+        scores[~empty] = -1
+        cells = scores.argmax(axis=1)
+        cells[~empty.any(axis=1)] = -1
+        return cells
+
+    def _spawn(self, games: np.ndarray, color: int) -> np.ndarray:
+        """
+        Sets one apple of the given color on each of the given boards.
+
+        Args:
+            games (np.ndarray): Indices of the games.
+            color (int): GREEN or RED.
+
+        Returns:
+            np.ndarray: Indices of the games with no empty cell left, which
+                are won.
+        """
+        if not games.size:
+            return games
+        cells = self._pick_empty(games)
+        full = cells < 0
+        self.flat[games[~full], cells[~full]] = color
+        return games[full]
@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from agent import Agent
+from batch_agent import BatchAgent
+from distributed import Learner
+from environment import Environment
+from interpreter import Interpreter
+from qtable import MappedQTable, save_binary
+from sparse_environment import SparseEnvironment
+from utils import Action, GameState, Movement, Settings, Step
+
+MOVES = [Movement.move_up, Movement.move_down, Movement.move_left,
+         Movement.move_right]
+
+
+def parse_arguments():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the game engine, the agent and the models.")
+    parser.add_argument('--boardsizes', type=int, nargs='+',
+                        default=[10, 20, 40], help='Board sizes to run the \
+                        engine benchmarks on. Default is 10 20 40.')
+    parser.add_argument('--sessions', type=int, default=200, help='Number of \
+                        games per training and evaluation benchmark. Default \
+                        is 200.')
+    parser.add_argument('--steps', type=int, default=20000, help='Number of \
+                        calls per micro-benchmark. Default is 20000.')
+    parser.add_argument('--workers-sessions', type=int, default=2000,
+                        help='Number of games of the training benchmarks \
+                        with 1, 2 and 4 worker processes. Default is 2000.')
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=['models/normal/600k_normal',
+                                 'models/universal/300k_univ'],
+                        help='Models to benchmark loading, saving and \
+                        evaluation with. Models in a "universal" directory \
+                        are evaluated in universal mode.')
+    parser.add_argument('--output', type=str, default='bench_results.json',
+                        help='Path of the JSON results. Default is \
+                        bench_results.json.')
+    parser.add_argument('--compare', type=str, help='Path of earlier JSON \
+                        results to compare with')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for random number generator')
+    return parser.parse_args()
+
+
+class CountingInterpreter(Interpreter):
+    """
+    An interpreter that counts the moves it makes.
+    """
+    def __init__(self, settings: Settings) -> None:
+        super().__init__(settings)
+        self.steps = 0
+
+    def _request_action(self) -> Action:
+        self.steps += 1
+        return super()._request_action()
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def qtable_footprint(table) -> int:
+    """
+    Approximate memory used by a Q-table, in bytes.
+    """
+    if isinstance(table, MappedQTable):
+        return len(table.values) * table.values.itemsize
+    return (sys.getsizeof(table.ids) + sys.getsizeof(table.keys)
+            + sum(sys.getsizeof(key) for key in table.keys)
+            + table.values.buffer_info()[1] * table.values.itemsize)
+
+
+def bench_environment(boardsize: int, steps: int, sparse: bool = False
+                      ) -> dict:
+    """
+    Random moves and views on the environment, restarting lost games.
+    """
+    settings = Settings(boardsize=boardsize, env_size=boardsize + 2)
+    step = Step()
+    env = (SparseEnvironment if sparse else Environment)(settings, step)
+    games = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        env.move(random.choice(MOVES)(env.snake_position[0]))
+        if step.state != GameState.RUNNING:
+            step.state = GameState.RUNNING
+            env.reset()
+            games += 1
+        else:
+            env.view(True)
+    elapsed = time.perf_counter() - start
+    return {'steps_per_sec': steps / elapsed,
+            'sessions_per_sec': games / elapsed}
+
+
+def bench_view(boardsize: int, universal: bool, steps: int) -> dict:
+    """
+    Snake view extraction on boards from random play.
+    """
+    settings = Settings(boardsize=boardsize, env_size=boardsize + 2,
+                        universal=universal)
+    play = Interpreter(settings)
+    boards = []
+    while len(boards) < 200:
+        step = Step()
+        env = Environment(settings, step)
+        for _ in range(random.randrange(10)):
+            env.move(random.choice(MOVES)(env.snake_position[0]))
+            if step.state != GameState.RUNNING:
+                break
+        else:
+            boards.append(env)
+    start = time.perf_counter()
+    for i in range(steps):
+        play.env = boards[i % len(boards)]
+        play._get_snake_view()
+    return {'views_per_sec': steps / (time.perf_counter() - start)}
+
+
+def bench_update(steps: int) -> dict:
+    """
+    Bellman updates on states seen by a universal agent.
+    """
+    settings = Settings(universal=True, sessions=20)
+    play = Interpreter(settings)
+    play.run()
+    agent = play.ag
+    keys = list(agent.qtable.keys)
+    states = [agent.encode({a: random.choice(keys) for a in Action})
+              for _ in range(256)]
+    start = time.perf_counter()
+    for i in range(steps):
+        agent.update_q_table(states[i % 256], states[(i + 1) % 256],
+                             Action.UP, -1)
+    return {'updates_per_sec': steps / (time.perf_counter() - start)}
+
+
+def bench_batch(steps: int, batch: int = 1024) -> dict:
+    """
+    Batched action selection and Bellman updates over random states.
+    """
+    agent = BatchAgent(seed=random.getrandbits(32))
+    for i in range(4096):
+        agent.qtable[str(i)] = random.uniform(-100, 20)
+    states = agent.rng.integers(0, 4096, (batch, 4))
+    rewards = np.full(batch, -1)
+    rounds = max(steps // batch, 1)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        actions = agent.select_actions(states, 0.9)
+        agent.update_q_tables(states, states[::-1], actions, rewards)
+    elapsed = time.perf_counter() - start
+    return {'steps_per_sec': rounds * batch / elapsed}
+
+
+def bench_game(boardsize: int, universal: bool, sessions: int,
+               load_path: str | None = None, greedy: bool = False) -> dict:
+    """
+    Full game loop: training from scratch, or evaluation of a model.
+    """
+    settings = Settings(boardsize=boardsize, env_size=boardsize + 2,
+                        sessions=sessions, universal=universal,
+                        load_path=load_path, dontlearn=bool(load_path),
+                        exploit=bool(load_path), greedy=greedy)
+    play = CountingInterpreter(settings)
+    elapsed = timed(play.run)
+    return {'steps_per_sec': play.steps / elapsed,
+            'sessions_per_sec': sessions / elapsed,
+            'qtable_states': len(play.ag.qtable),
+            'qtable_bytes': qtable_footprint(play.ag.qtable)}
+
+
+def bench_workers(workers: int, sessions: int,
+                  load_path: str | None = None) -> dict:
+    """
+    Training with actor processes and a learner, from scratch or from a
+    model, whose table the actors and the learner keep in sync.
+    """
+    settings = Settings(sessions=sessions, workers=workers,
+                        load_path=load_path)
+    play = Learner(settings)
+    elapsed = timed(play.run)
+    return {'sessions_per_sec': sessions / elapsed,
+            'qtable_states': len(play.ag.qtable)}
+
+
+def bench_model(path: str) -> dict:
+    """
+    Loading and saving a model in both formats.
+    """
+    agent = Agent()
+    result = {'load_json_sec': timed(agent.load_q_table, path),
+              'qtable_states': len(agent.qtable),
+              'qtable_bytes': qtable_footprint(agent.qtable)}
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, 'model')
+        binary_path = os.path.join(directory, 'model.qtb')
+        result['save_json_sec'] = timed(agent.save_q_table, json_path)
+        result['save_binary_sec'] = timed(save_binary, agent.qtable,
+                                          binary_path)
+        result['load_binary_sec'] = timed(agent.load_q_table, binary_path)
+        start = time.perf_counter()
+        mapped = MappedQTable(binary_path)
+        result['map_binary_sec'] = time.perf_counter() - start
+        result['mapped_bytes'] = qtable_footprint(mapped)
+        mapped.close()
+        result['file_json_bytes'] = os.path.getsize(json_path)
+        result['file_binary_bytes'] = os.path.getsize(binary_path)
+    return result
+
+
+def run_benchmarks(args) -> list:
+    results = []
+
+    def record(name, params, function, *function_args):
+        random.seed(args.seed)
+        metrics = function(*function_args)
+        results.append({'name': name, 'params': params, **metrics})
+        summary = ', '.join(f'{k}={v:.4g}' for k, v in metrics.items())
+        print(f'{name} {params}: {summary}')
+
+    for size in args.boardsizes:
+        for sparse in (False, True):
+            record('environment', {'boardsize': size, 'sparse': sparse},
+                   bench_environment, size, args.steps, sparse)
+        for universal in (False, True):
+            params = {'boardsize': size, 'universal': universal}
+            record('view', params, bench_view, size, universal, args.steps)
+            record('train', params, bench_game, size, universal,
+                   args.sessions)
+    record('update', {}, bench_update, args.steps)
+    record('batch', {}, bench_batch, args.steps)
+    for path in [None] + args.models[:1]:
+        for workers in (1, 2, 4):
+            record('workers', {'workers': workers, 'path': path},
+                   bench_workers, workers, args.workers_sessions, path)
+    for path in args.models:
+        universal = 'universal' in path.split(os.sep)
+        record('model', {'path': path}, bench_model, path)
+        for greedy in (False, True):
+            record('evaluate', {'path': path, 'universal': universal,
+                                'greedy': greedy},
+                   bench_game, 10, universal, args.sessions, path, greedy)
+    return results
+
+
+def compare(results: list, path: str) -> None:
+    """
+    Prints the ratio of every metric to the same metric in earlier results.
+    """
+    with open(path, 'r') as f:
+        previous = {(r['name'], json.dumps(r['params'], sort_keys=True)): r
+                    for r in json.load(f)['results']}
+    for result in results:
+        key = (result['name'], json.dumps(result['params'], sort_keys=True))
+        if key not in previous:
+            continue
+        ratios = ', '.join(
+            f'{k}={v / previous[key][k]:.2f}x'
+            for k, v in result.items()
+            if isinstance(v, (int, float)) and previous[key].get(k))
+        print(f'{result["name"]} {result["params"]}: {ratios}')
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_arguments()
+    results = run_benchmarks(args)
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'revision': git_revision(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print('Results were saved to', args.output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
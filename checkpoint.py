@@ -0,0 +1,133 @@
+import itertools
+from array import array
+import json
+import random
+from collections import Counter
+
+from qtable import QTable, iter_json
+from utils import Settings, atomic_write
+
+VERSION = 1
+
+
+def parse_sessions(path: str | None) -> int:
+    """
+    Returns the number of sessions encoded in a model name such as
+    `100k_normal`, or 0 if there is none.
+    """
+    if not path:
+        return 0
+    number = path.split('/')[-1].split('_')[0]
+    separate = number.split('k')
+    return int(separate[0]) * 1000 ** (len(separate) - 1)
+
+
+def format_sessions(number: int) -> str:
+    """
+    Writes a number of sessions the way model names do, e.g. 100000 as
+    `100k`.
+    """
+    exp = 0
+    while number and number % 1000 == 0:
+        exp += 1
+        number //= 1000
+    return f'{number}{"k" * exp}'
+
+
+def save(path: str, play, epoch: int, base_sessions: int,
+         stat_dict: dict, writer=None) -> None:
+    """
+    Atomically writes a checkpoint from which training can be resumed.
+
+    The checkpoint holds the Q-table and everything else the trainer needs
+    to continue where it stopped: the settings, the epoch and round, the
+    exploitation rate, the statistics so far, the index of the next game,
+    the state of `random` and the transitions of the replay buffer. The
+    random generators of the games are derived from the seed and the game
+    index, so they need no state.
+    It must be taken between two games.
+
+    Args:
+        path (str): The path of the checkpoint file.
+        play (Interpreter | Learner): The trainer.
+        epoch (int): The epoch the trainer is in.
+        base_sessions (int): The number of sessions the loaded model had
+            been trained for.
+        stat_dict (dict): The statistics of the finished epochs.
+        writer (BackgroundWriter | None): Writes the checkpoint in the
+            background from a snapshot; it's written right away without.
+    """
+    step = getattr(play, 'step', None)
+    state = {
+        'version': VERSION,
+        'epoch': epoch,
+        'base_sessions': base_sessions,
+        'settings': vars(play.settings),
+        'exploitation_rate': play.exploitation_rate,
+        'game': getattr(play, 'game', None),
+        'random_state': random.getstate(),
+        'stats': vars(play.stats.snapshot()),
+        'step': step and {k: v for k, v in vars(step).items()
+                          if k != 'state'},
+        'stat_dict': {k: list(v) for k, v in stat_dict.items()},
+        'replay': play.replay and play.replay.get_state(),
+    }
+    qtable = play.ag.qtable.snapshot()
+
+    def encode():
+        state['visits'] = qtable.visits.tolist()
+        head = json.dumps(state)[:-1].encode()
+        return itertools.chain([head, b', "qtable": '], iter_json(qtable),
+                               [b'}'])
+    if writer:
+        writer.submit(path, encode)
+    else:
+        atomic_write(path, encode())
+
+
+def load(path: str) -> dict:
+    """
+    Reads a checkpoint written by `save`.
+    """
+    with open(path, 'r') as f:
+        state = json.load(f)
+    if state.get('version') != VERSION:
+        raise ValueError(f'Unsupported checkpoint version '
+                         f'{state.get("version")}')
+    state['settings'] = Settings(**state['settings'])
+    return state
+
+
+def restore(play, state: dict, stat_dict: dict) -> None:
+    """
+    Puts a new trainer in the state saved in a checkpoint.
+
+    Args:
+        play (Interpreter | Learner): A trainer created with the settings
+            of the checkpoint.
+        state (dict): The checkpoint, as returned by `load`.
+        stat_dict (dict): Receives the statistics of the finished epochs.
+    """
+    play.ag.qtable = QTable.from_dict(state['qtable'])
+    if state.get('visits'):
+        play.ag.qtable.visits = array('L', state['visits'])
+    play.exploitation_rate = state['exploitation_rate']
+    stats = state['stats']
+    stats['lengths'] = Counter({int(k): v
+                                for k, v in stats['lengths'].items()})
+    vars(play.stats).update(stats)
+    if state['step'] and hasattr(play, 'step'):
+        vars(play.step).update(state['step'])
+    if hasattr(play, 'epoch'):
+        play.epoch = state['epoch']
+    if state.get('game') is not None and hasattr(play, 'game'):
+        play.game = state['game']
+    for column, values in state['stat_dict'].items():
+        stat_dict[column].extend(values)
+    version, internal, gauss = state['random_state']
+    random.setstate((version, tuple(internal), gauss))
+    if state.get('replay') and play.replay:
+        play.replay.set_state(state['replay'])
+    if hasattr(play, 'playing'):
+        # The game set up on creation used other random draws.
+        play.playing = False
@@ -0,0 +1,43 @@
+import argparse
+
+from qtable import iter_json, load, save_binary
+
+
+def parse_arguments():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Convert Q-table models between JSON and binary format. \
+        Delta models are folded with their bases into full models.")
+    parser.add_argument('paths', nargs='+', help='Paths of the models to \
+                        convert')
+    parser.add_argument('--to', choices=['binary', 'json'], default='binary',
+                        help='Target format. Default is binary.')
+    parser.add_argument('--suffix', type=str, default='.qtb', help='Suffix \
+                        added to the path of every converted model. Default \
+                        is .qtb.')
+    parser.add_argument('--in-place', action='store_true', help='Replace \
+                        the models with the converted ones, e.g. to fold \
+                        delta models into full ones')
+    parser.add_argument('--indent', type=int, help='Pretty-print JSON \
+                        models with the given indentation')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    for path in args.paths:
+        target = path if args.in_place else path + args.suffix
+        # A model replaced in place can't stay memory-mapped.
+        table = load(path, read_only=target != path)
+        if args.to == 'binary':
+            save_binary(table, target)
+        else:
+            with open(target, 'wb') as f:
+                f.writelines(iter_json(table, args.indent))
+        print(f'{path} -> {target} ({len(table)} states)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+from array import array
+import multiprocessing
+import queue
+import random
+
+import numpy as np
+
+from agent import Agent
+from interpreter import Interpreter
+from utils import Action, Settings, Stats, GameState
+
+# Number of games an actor plays between two exchanges with the learner.
+SYNC_GAMES = 100
+
+
+class Actor(Interpreter):
+    """
+    An interpreter that plays its share of the sessions in its own process.
+
+    The actor learns on its local copy of the Q-table as usual, and also
+    records every transition. Every `SYNC_GAMES` games it sends them to the
+    learner and switches to the latest table the learner sent back.
+
+    The first `known` IDs of the local table are the learner's IDs of the
+    same views, so transitions are recorded as IDs. The views the actor
+    added after them are sent once per batch, and only the views it
+    doesn't know at all are sent as strings. The learner answers with the
+    changes since its previous answer (see `Learner.delta`), which make the
+    local table a copy of the learner's again.
+
+    Attributes:
+        worker (int): Index of the actor.
+        transitions (list): Transitions since the last exchange, as
+            (state IDs, action value, reward, next state IDs or None), with
+            the views of unknown next state IDs instead.
+        known (int): Number of IDs the local table shares with the
+            learner's.
+        base (np.ndarray): The values of the learner's table when it last
+            answered.
+    """
+    def __init__(self, worker: int, settings: Settings, qtable,
+                 exploitation_rate: float, outbox, inbox) -> None:
+        super().__init__(settings)
+        self.worker = worker
+        self.ag.qtable = qtable
+        self.exploitation_rate = exploitation_rate
+        self.outbox = outbox
+        self.inbox = inbox
+        self.transitions = []
+        self.synced = 0
+        self.known = len(qtable)
+        self.base = np.array(qtable.values)
+
+    def _send_reward(self) -> None:
+        if self.settings.dontlearn:
+            return
+        super()._send_reward()
+        next_ids = self.next_state and self.ag.encode(self.next_state)
+        self.transitions.append((
+            tuple(self.state_ids[a] for a in Action),
+            self.action.value,
+            self._calculate_reward(),
+            next_ids and tuple(next_ids[a] if next_ids[a] >= 0
+                               else self.next_state[a] for a in Action)))
+
+    def _update_stats(self) -> None:
+        finished = self.step.state != GameState.RUNNING
+        super()._update_stats()
+        if finished and self.stats.round % SYNC_GAMES == 0:
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        Sends the recorded transitions to the learner and applies the
+        changes it pushed back, if any, without waiting for them.
+        """
+        games = self.stats.round - self.synced
+        added = self.ag.qtable.keys[self.known:]
+        self.outbox.put((self.worker, 'batch',
+                         (games, self.known, added, self.transitions)))
+        self.transitions = []
+        self.synced = self.stats.round
+        try:
+            while True:
+                self._pull(self.inbox.get_nowait())
+        except queue.Empty:
+            pass
+
+    def _pull(self, delta: tuple) -> None:
+        """
+        Turns the local table into the learner's table of a `Learner.delta`:
+        the views added since the last pull are dropped, the learner's new
+        views are appended in its order and its values are copied.
+        """
+        changed, values, keys, added = delta
+        table = self.ag.qtable
+        for key in table.keys[self.known:]:
+            del table.ids[key]
+        del table.keys[self.known:]
+        for key in keys:
+            table.ids[key] = len(table.keys)
+            table.keys.append(key)
+        self.base[changed] = values
+        self.base = np.concatenate([self.base, added])
+        table.values = array('d', self.base.tobytes())
+        del table.visits[self.known:]
+        table.visits.frombytes(bytes(table.visits.itemsize * len(keys)))
+        self.known = len(table)
+
+
+def run_actor(worker: int, settings: Settings, seed: str, first_game: int,
+              qtable, exploitation_rate: float, outbox, inbox) -> None:
+    """
+    Entry point of an actor process.
+    """
+    random.seed(seed)
+    actor = Actor(worker, settings, qtable, exploitation_rate, outbox, inbox)
+    actor.game = first_game
+    actor.run()
+    actor.sync()
+    outbox.put((worker, 'done',
+                (actor.stats.snapshot(), actor.exploitation_rate)))
+
+
+class Learner:
+    """
+    Trains one Q-table with several actor processes.
+
+    The learner owns the agent. It applies the Bellman updates of the
+    transitions the actors send, in the order they arrive, and answers
+    every batch with the changes of the table since its previous answer to
+    the same actor. Each actor plays an equal share of
+    the sessions with its own copy of the exploitation-rate
+    schedule, so an epoch has the same number of games as a serial one.
+    The order in which batches arrive depends on timing, so runs are not
+    reproducible game for game the way serial training is.
+
+    Attributes:
+        settings (Settings): The configuration of the run.
+        stats (Stats): The statistics of the actors, merged.
+        ag (Agent): The agent that holds the Q-table.
+        exploitation_rate (float): Exploitation rate the next epoch starts
+            with.
+        workers (int): Number of actor processes.
+        epoch (int): Number of epochs run so far.
+        on_round_end (callable | None): Called with the number of rounds
+            the actors reported in this epoch after every batch.
+        replay (ReplayBuffer | None): The transitions replayed to the agent,
+            with `settings.replay`; the actors don't replay. It samples
+            from a generator derived for every epoch from the seed and the
+            index of its first game.
+        pushed (dict): {worker: values of the table as last sent to the
+            actor} in the current epoch.
+    """
+    def __init__(self, settings: Settings, stats: Stats | None = None
+                 ) -> None:
+        self.settings = settings
+        self.stats = stats or Stats()
+        self.exploitation_rate = float(settings.exploit) or 0.0
+        self.workers = max(min(settings.workers, settings.sessions), 1)
+        self.epoch = 0
+        self.on_round_end = None
+        self.replay = None
+        self.pushed = {}
+        if settings.replay:
+            from batch_agent import BatchAgent
+            from replay import ReplayBuffer
+
+            self.ag = BatchAgent()
+            self.replay = ReplayBuffer(settings.replay, settings.prioritized,
+                                       self.ag.rng)
+        else:
+            self.ag = Agent()
+        if settings.load_path:
+            self.ag.load_q_table(settings.load_path)
+
+    def run(self) -> None:
+        """
+        Runs one epoch and adds the statistics of all actors to `stats`.
+        """
+        context = multiprocessing.get_context()
+        outbox = context.Queue()
+        inboxes = [context.Queue() for _ in range(self.workers)]
+        sessions = self.settings.sessions
+        # Every actor plays the games of its own range of game indices.
+        first_game = self.epoch * sessions
+        if self.replay:
+            from batch_agent import game_generator
+
+            # Batches arrive in any order, so the replays of an epoch draw
+            # from one generator, derived from its first game.
+            self.ag.rng = self.replay.rng = game_generator(
+                self.settings.seed, 'replay', first_game)
+        processes = []
+        values = np.array(self.ag.qtable.values)
+        for worker in range(self.workers):
+            settings = self.settings.replace(
+                sessions=(sessions // self.workers
+                          + (worker < sessions % self.workers)),
+                load_path=None, visual=False, step_by_step=False, replay=0)
+            processes.append(context.Process(
+                target=run_actor,
+                args=(worker, settings,
+                      f'{self.settings.seed}:{self.epoch}:{worker}',
+                      first_game, self.ag.qtable.copy(),
+                      self.exploitation_rate, outbox, inboxes[worker])))
+            self.pushed[worker] = values
+            first_game += settings.sessions
+        for process in processes:
+            process.start()
+
+        running = self.workers
+        rounds = 0
+        while running:
+            worker, kind, payload = outbox.get()
+            if kind == 'batch':
+                games, known, added, transitions = payload
+                self._apply(known, added, transitions)
+                inboxes[worker].put(self.delta(worker))
+                rounds += games
+                if games and self.on_round_end:
+                    self.on_round_end(rounds)
+            else:
+                stats, rate = payload
+                self.stats.merge(stats)
+                self.exploitation_rate = rate
+                running -= 1
+        for process in processes:
+            process.join()
+        for inbox in inboxes:
+            inbox.cancel_join_thread()
+            inbox.close()
+        self.epoch += 1
+
+    def delta(self, worker: int) -> tuple:
+        """
+        The changes of the table since it was last sent to an actor.
+
+        The values are compared with those last sent in one vectorized
+        pass; IDs are only ever appended, so the views the actor doesn't
+        have are the last ones of the table. The arrays are new, since
+        queues pickle in a background thread.
+
+        Args:
+            worker (int): Index of the actor.
+
+        Returns:
+            tuple: The IDs of the changed values the actor has, their new
+                values, and the views and values added after them.
+        """
+        table = self.ag.qtable
+        sent = self.pushed[worker]
+        values = np.array(table.values)
+        changed = np.flatnonzero(values[:len(sent)] != sent)
+        self.pushed[worker] = values
+        return (changed, values[changed], table.keys[len(sent):],
+                values[len(sent):])
+
+    def _apply(self, known: int, added: list, transitions: list) -> None:
+        """
+        Applies the Bellman updates of a batch of transitions.
+
+        Args:
+            known (int): Number of IDs the actor shares with the table.
+            added (list[str]): The views of the actor's IDs from `known` on.
+            transitions (list): The transitions, as in `Actor.transitions`.
+        """
+        table = self.ag.qtable
+        # The table's IDs of the views in `added`, looked up when first
+        # used; a view only seen as a next state may not be in it yet.
+        ids = [-1] * len(added)
+
+        def encode(state, learn):
+            state_ids = {}
+            for a, i in zip(Action, state):
+                if isinstance(i, str):
+                    i = table.get_id(i)
+                elif i >= known:
+                    if ids[i - known] < 0:
+                        view = added[i - known]
+                        ids[i - known] = (table.intern(view) if learn
+                                          else table.get_id(view))
+                    i = ids[i - known]
+                state_ids[a] = i
+            return state_ids
+
+        for state, action, reward, next_state in transitions:
+            state_ids = encode(state, True)
+            if self.ag.count_visits:
+                self.ag.count_visit(state_ids)
+            next_ids = next_state and encode(next_state, False)
+            self.ag.update_q_table(state_ids, next_ids, Action(action),
+                                   reward)
+            if self.replay:
+                self.replay.add(state_ids, Action(action), reward, next_ids)
+                if self.replay.added % self.settings.replay_every == 0:
+                    self.replay.replay(self.ag, self.settings.replay_batch)
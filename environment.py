@@ -1,16 +1,149 @@
-from utils import Step, GameState, Position, Settings
+from utils import Step, GameState, Position, Settings, Action
+import functools
+import itertools
 import random
 
+# Index of the direction from a snake segment to the one before it, in
+# the link keys of `zobrist_keys`.
+DIRECTIONS = {(0, -1): 0, (0, 1): 1, (-1, 0): 2, (1, 0): 3}
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def squash(ray: str) -> str:
+    """
+    Collapses runs of the same cell type into one cell, e.g. "000G00W"
+    becomes "0G0W", which is the view used by universal models.
+    """
+    return ''.join([i[0] for i in itertools.groupby(ray)])
+
+
+@functools.lru_cache
+def zobrist_keys(size: int) -> tuple:
+    """
+    Random 64-bit keys of the board features hashed by `Environment.hash`,
+    the same for every board of a given size.
+
+    Returns:
+        tuple: {letter: key of every cell}, the keys of the links between
+            snake segments, indexed by cell * 4 + direction, and the hash
+            of the board with only walls.
+    """
+    rng = random.Random(f'zobrist:{size}')
+    cells = {letter: [rng.getrandbits(64) for _ in range(size * size)]
+             for letter in '0WSHGR'}
+    links = [rng.getrandbits(64) for _ in range(size * size * 4)]
+    walls = 0
+    for i in range(size * size):
+        y, x = divmod(i, size)
+        wall = x in (0, size - 1) or y in (0, size - 1)
+        walls ^= cells['W' if wall else '0'][i]
+    return cells, links, walls
+
+
+@functools.lru_cache
+def board_template(size: int) -> tuple:
+    """
+    The parts of an empty board with only walls that `Environment.reset`
+    copies, the same for every board of a given size.
+
+    Returns:
+        tuple: The rows of cells, the row and column bytes, and the
+            `FreeCells` of the board.
+    """
+    state = [['W' if x in (0, size - 1) or y in (0, size - 1) else '0'
+              for x in range(size)] for y in range(size)]
+    free = FreeCells(size)
+    free.fill(cell == '0' for row in state for cell in row)
+    return (tuple(tuple(row) for row in state),
+            tuple(''.join(row).encode() for row in state),
+            tuple(''.join(column).encode() for column in zip(*state)),
+            free)
+
 
 class Environment:
-    def __init__(self) -> None:
+    """
+    A snake board with walls, apples and the snake itself.
+
+    Attributes:
+        settings (Settings): The configuration of the run.
+        step (Step): The state of the game, set to LOST or WON when the
+            game ends.
+        size (int): Side of the board including walls.
+        state (list): Rows of one-character cell strings.
+        rows (list[bytearray]): Every row of `state` as ASCII bytes, which
+            a cell write changes in place.
+        columns (list[bytearray]): Every column of `state` as ASCII bytes.
+        snake_position (list[Position]): Snake cells from head to tail.
+        free (FreeCells): The empty cells of the board.
+        duration (int): Number of moves made in the current game.
+        version (int): Number of moves and resets of the board; `dirty`
+            holds the changes from the previous version to this one.
+        dirty (list | None): (x, y, letter) of every cell write of the last
+            move, in order, or None after `reset`, which rewrites the board.
+        rng (random.Random): Source of the placement of the snake and the
+            apples, or the `random` module.
+        hash (int): Zobrist hash of the cells and of the order of the snake
+            segments, updated with every change, so equal hashes mean the
+            same board and snake.
+
+    Methods:
+        move(p: Position) -> str:
+            Moves the snake head to a cell.
+        reset(rng: random.Random | None) -> None:
+            Sets up a new game on the same board.
+        view(universal: bool) -> dict:
+            Returns what the snake sees in every direction.
+    """
+    def __init__(self, settings: Settings, step: Step,
+                 rng: random.Random | None = None) -> None:
         """
         Initialize the environment with a snake and apples.
+
+        Args:
+            settings (Settings): The configuration of the run.
+            step (Step): The state of the game.
+            rng (random.Random | None): Source of the placements, e.g. from
+                `game_rng`; the `random` module by default.
         """
-        self.duration = 0
+        self.settings = settings
+        self.step = step
+        self.size = settings.env_size
+        self.keys, self.links, _ = zobrist_keys(self.size)
+        self.free = FreeCells(settings.env_size)
         self.state = self._initialize_board()
+        self.version = 0
+        self.reset(rng)
+
+    def reset(self, rng: random.Random | None = None) -> None:
+        """
+        Sets up a new game with a new snake and apples, reusing the board.
+
+        Only the rows and columns the last game changed are copied back
+        from the template of the empty board, and the empty cells and the
+        hash are restored in bulk, so no board is built. The placements
+        then draw from `rng` exactly as on a new `Environment`.
+
+        Args:
+            rng (random.Random | None): Source of the placements, e.g. from
+                `game_rng`; the `random` module by default.
+        """
+        state, rows, columns, free = board_template(self.size)
+        for y, row in enumerate(self.rows):
+            if row != rows[y]:
+                self.state[y][:] = state[y]
+                row[:] = rows[y]
+        for x, column in enumerate(self.columns):
+            if column != columns[x]:
+                column[:] = columns[x]
+        self.free.copy(free)
+        self.hash = zobrist_keys(self.size)[2]
+        self.rng = rng or random
+        self.duration = 0
+        self.dirty = []
         self.snake_position = self._initialize_snake()
         self._initialize_apples()
+        self.dirty = None
+        self.version += 1
 
     def move(self, p: Position) -> str:
         """
@@ -23,29 +156,54 @@ class Environment:
         Returns:
             str: The cell type where the snake's head landed.
         """
+        self.dirty = []
         x_new, y_new = p.x, p.y
         letter = self.state[y_new][x_new]
         if letter in ['W', 'S'] or (letter == 'R' and
                                     len(self.snake_position) == 1):
-            Step.state = GameState.LOST
+            self.step.state = GameState.LOST
         else:
             if letter in ['0', 'R']:
-                tail = self.snake_position.pop()
-                self.state[tail.y][tail.x] = '0'
+                self._pop_tail()
             if letter == 'R':
-                tail = self.snake_position.pop()
-                self.state[tail.y][tail.x] = '0'
+                self._pop_tail()
                 self._set_apple(1, 'R')
             elif letter == 'G':
                 self._set_apple(1, 'G')
             self.snake_position.insert(0, Position(x_new, y_new))
-            self.state[y_new][x_new] = 'H'
+            self._set_cell(x_new, y_new, 'H')
             if len(self.snake_position) > 1:
-                self.state[self.snake_position[1].y][
-                    self.snake_position[1].x] = 'S'
+                self._set_cell(*self.snake_position[1], 'S')
+                self._link(self.snake_position[1], self.snake_position[0])
         self.duration += 1
+        self.version += 1
         return letter
 
+    def view(self, universal: bool = False) -> dict:
+        """
+        Returns the rays from the head to the walls, nearest cell first.
+
+        Only the four rays are decoded from the row and column bytes.
+
+        Args:
+            universal (bool): Whether runs of the same cell type are
+                collapsed into one cell.
+
+        Returns:
+            dict: {Action: ray} for every direction.
+        """
+        x, y = self.snake_position[0]
+        row, column = self.rows[y], self.columns[x]
+        view = {
+            Action.UP: column[y-1::-1].decode(),
+            Action.DOWN: column[y + 1:].decode(),
+            Action.LEFT: row[x-1::-1].decode(),
+            Action.RIGHT: row[x + 1:].decode()
+        }
+        if universal:
+            return {a: squash(ray) for a, ray in view.items()}
+        return view
+
     def print_env(self) -> None:
         """
         Prints the current state of the environment.
@@ -55,21 +213,15 @@ class Environment:
 
     def _initialize_board(self) -> list:
         """
-        Sets walls and empty cells.
+        Sets walls and empty cells; the empty cells are counted by `reset`.
 
         Returns:
             list: The initialized board state.
         """
-        arr = list([[] for _ in range(Settings.env_size)])
-        for i in range(Settings.env_size):
-            for j in range(Settings.env_size):
-                if (i in [0, Settings.env_size - 1]
-                        or j in [0, Settings.env_size - 1]):
-                    fill = 'W'
-                else:
-                    fill = '0'
-                arr[i].append(fill)
-        return arr
+        state, rows, columns, _ = board_template(self.size)
+        self.rows = [bytearray(row) for row in rows]
+        self.columns = [bytearray(column) for column in columns]
+        return [list(row) for row in state]
 
     def _initialize_snake(self) -> list[Position]:
         """
@@ -83,18 +235,19 @@ class Environment:
 
         # Set snake head
         x, y = self._get_empty_cell()
-        self.state[y][x] = 'H'
+        self._set_cell(x, y, 'H')
         snake_position = [Position(x, y)]
 
         # Set snake body
         for _ in range(2):
             while True:
-                x_new, y_new = random.choice([(x, y - 1), (x, y + 1),
-                                              (x - 1, y), (x + 1, y)])
+                x_new, y_new = self.rng.choice([(x, y - 1), (x, y + 1),
+                                                (x - 1, y), (x + 1, y)])
                 if self._is_empty(x_new, y_new):
                     x, y = x_new, y_new
-                    self.state[y][x] = 'S'
+                    self._set_cell(x, y, 'S')
                     snake_position.append(Position(x, y))
+                    self._link(snake_position[-1], snake_position[-2])
                     break
 
         return snake_position
@@ -116,8 +269,50 @@ class Environment:
         """
         for _ in range(number):
             x, y = self._get_empty_cell()
-            if Step.state == GameState.RUNNING:
-                self.state[y][x] = color
+            if self.step.state == GameState.RUNNING:
+                self._set_cell(x, y, color)
+
+    def _set_cell(self, x: int, y: int, letter: str) -> None:
+        """
+        Writes a cell and keeps the set of empty cells and the row and
+        column bytes in sync with it, in constant time, and records it in
+        `dirty`.
+
+        Args:
+            x (int): The x-coordinate of the cell.
+            y (int): The y-coordinate of the cell.
+            letter (str): The new cell type.
+        """
+        old = self.state[y][x]
+        keys = self.keys
+        i = y * self.size + x
+        self.hash ^= keys[old][i] ^ keys[letter][i]
+        was_empty = old == '0'
+        if was_empty and letter != '0':
+            self.free.discard(x, y)
+        elif not was_empty and letter == '0':
+            self.free.add(x, y)
+        self.state[y][x] = letter
+        self.rows[y][x] = self.columns[x][y] = ord(letter)
+        self.dirty.append((x, y, letter))
+
+    def _pop_tail(self) -> None:
+        """
+        Removes the last segment of the snake.
+        """
+        tail = self.snake_position.pop()
+        self._set_cell(tail.x, tail.y, '0')
+        if self.snake_position:
+            self._link(tail, self.snake_position[-1])
+
+    def _link(self, segment: Position, previous: Position) -> None:
+        """
+        Adds the link between a snake segment and the one before it,
+        towards the head, to `hash`, or removes it when it's there.
+        """
+        i = segment.y * self.size + segment.x
+        self.hash ^= self.links[i * 4 + DIRECTIONS[
+            previous.x - segment.x, previous.y - segment.y]]
 
     def _is_empty(self, x, y) -> bool:
         """
@@ -136,17 +331,88 @@ class Environment:
         """
         Returns the coordinates of an empty cell.
 
+        The cell is drawn with the same `choice` call over the empty cells
+        in row-major order as a full board scan would make, so a given seed
+        still produces the same games.
+
         Returns:
             Position: The coordinates of an empty cell.
         """
-        empty = [
-            Position(x, y)
-            for y, line in enumerate(self.state)
-            for x, _ in enumerate(line)
-            if self.state[y][x] == '0'
-            ]
-        if len(empty) == 0:
+        if self.free.count == 0:
             print("YOU WON!!!!")
-            Step.state = GameState.WON
+            self.step.state = GameState.WON
             return None, None
-        return random.choice(empty)
+        return self.free.select(self.rng.choice(range(self.free.count)))
+
+
+class FreeCells:
+    """
+    The empty cells of a board, ordered row by row.
+
+    A Fenwick tree over the row-major cell indices keeps a count of empty
+    cells per prefix, so adding, removing and finding the k-th empty cell
+    take O(log(env_size²)) instead of a scan of the whole board.
+
+    Attributes:
+        size (int): Side of the board including walls.
+        count (int): Number of empty cells.
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.count = 0
+        self._n = size * size
+        self._tree = [0] * (self._n + 1)
+        self._top = 1 << (self._n.bit_length() - 1)
+
+    def fill(self, empty) -> None:
+        """
+        Rebuilds the set in O(env_size²) from row-major emptiness flags.
+
+        Args:
+            empty (Iterable[bool]): True for every empty cell.
+        """
+        tree = [0] + [int(e) for e in empty]
+        self.count = sum(tree)
+        for i in range(1, self._n + 1):
+            parent = i + (i & -i)
+            if parent <= self._n:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def copy(self, other: 'FreeCells') -> None:
+        """
+        Makes the set the same as another one of the same size, in place.
+        """
+        self._tree[:] = other._tree
+        self.count = other.count
+
+    def add(self, x: int, y: int) -> None:
+        self._update(y * self.size + x + 1, 1)
+
+    def discard(self, x: int, y: int) -> None:
+        self._update(y * self.size + x + 1, -1)
+
+    def select(self, k: int) -> Position:
+        """
+        Returns the k-th (0-based) empty cell in row-major order.
+
+        Args:
+            k (int): Rank of the cell, lower than `count`.
+
+        Returns:
+            Position: The coordinates of the cell.
+        """
+        i, bit = 0, self._top
+        while bit:
+            j = i + bit
+            if j <= self._n and self._tree[j] <= k:
+                k -= self._tree[j]
+                i = j
+            bit >>= 1
+        return Position(i % self.size, i // self.size)
+
+    def _update(self, i: int, delta: int) -> None:
+        self.count += delta
+        while i <= self._n:
+            self._tree[i] += delta
+            i += i & -i
@@ -1,6 +1,7 @@
 import time
-from agent import Agent
+from agent import Agent, GreedyAgent
 from environment import Environment
+from sparse_environment import SparseEnvironment
 from utils import (
     KeyEvent,
     Settings,
@@ -10,23 +11,87 @@ from utils import (
     GameState,
     Movement,
     LIMIT_DURATION,
+    game_rng,
 )
-import itertools
 
-from visualize import Visualize
+
+ACTION_TO_FUNCTION = {
+    Action.UP: Movement.move_up,
+    Action.DOWN: Movement.move_down,
+    Action.LEFT: Movement.move_left,
+    Action.RIGHT: Movement.move_right
+}
 
 
 class Interpreter:
-    def __init__(self) -> None:
-        self.exploitation_rate = float(Settings.exploit) or 0.0
+    """
+    Plays the sessions of a run: asks the agent for moves, applies them to
+    the environment, rewards the agent and keeps the statistics.
+
+    Attributes:
+        settings (Settings): The configuration of the run.
+        stats (Stats): The statistics of the run.
+        step (Step): The state of the current game.
+        env (Environment | SparseEnvironment | None): The board of the
+            current game, reset in place for every new one; None before the
+            first game.
+        playing (bool): Whether a game is set up on `env`.
+        game (int): Index of the next game in the run, from which the
+            random streams of its board and of the agent are derived.
+        stats_every (int): Number of rounds after which the records of
+            `step` are added to `stats`; a tenth of the sessions.
+        seen (set | None): Hashes of the boards of the current game since
+            the last random event, when looping games are cut short.
+        picks (int): `ag.random_picks` when `seen` was last cleared.
+        ag (Agent): The agent that plays.
+        replay (ReplayBuffer | None): The transitions replayed to the agent
+            every `settings.replay_every` moves, with `settings.replay`. It
+            samples from the generator of the agent, derived for every game
+            from the seed and the game index.
+        exploitation_rate (float): The current exploitation rate.
+        on_round_end (callable | None): Called with the number of rounds
+            played so far after every finished round, before the next game
+            is set up.
+    """
+    def __init__(self, settings: Settings, stats: Stats | None = None
+                 ) -> None:
+        self.settings = settings
+        self.stats = stats or Stats()
+        self.step = Step()
+        self.exploitation_rate = float(settings.exploit) or 0.0
         self.state = None
+        self.state_ids = None
         self.next_state = None
         self.current_cell = None
         self.action = None
-        self.env = Environment()
-        self.ag = Agent()
-        if Settings.load_path:
-            self.ag.load_q_table(Settings.load_path)
+        self.on_round_end = None
+        self.env = None
+        self.playing = False
+        self.game = 0
+        self.stats_every = max(settings.sessions // 10, 1)
+        # A frozen model that always exploits plays a deterministic policy
+        # except for tie-breaks, so its loops can be detected.
+        self.seen = None
+        self.picks = 0
+        if (settings.detect_cycles and settings.dontlearn
+                and settings.exploit and not settings.visual):
+            self.seen = set()
+        self.replay = None
+        if settings.greedy and settings.dontlearn:
+            self.ag = GreedyAgent()
+        elif settings.replay and not settings.dontlearn:
+            from batch_agent import BatchAgent
+            from replay import ReplayBuffer
+
+            # Both draw from the generator `_new_game` sets for every game.
+            self.ag = BatchAgent()
+            self.replay = ReplayBuffer(settings.replay, settings.prioritized,
+                                       self.ag.rng)
+        else:
+            self.ag = Agent()
+        if settings.load_path:
+            self.ag.load_q_table(settings.load_path,
+                                 read_only=settings.dontlearn)
 
     def _calculate_reward(self) -> int:
         if self.current_cell in ['W', 'S']:
@@ -39,92 +104,153 @@ class Interpreter:
             return 20
 
     def _get_snake_view(self) -> dict:
-        x, y = self.env.snake_position[0]
-        vertical = [self.env.state[i][x] for i in range(Settings.env_size)]
-        if Settings.universal:
-            return {
-                Action.UP: ''.join([i[0] for i in itertools.groupby(
-                    vertical[y-1::-1])]),
-                Action.DOWN: ''.join([i[0] for i in itertools.groupby(
-                    vertical[y + 1:])]),
-                Action.LEFT: ''.join([i[0] for i in itertools.groupby(
-                    self.env.state[y][x-1::-1])]),
-                Action.RIGHT: ''.join([i[0] for i in itertools.groupby(
-                    self.env.state[y][x + 1:])])
-            }
-        return {
-            Action.UP: ''.join(vertical[y-1::-1]),
-            Action.DOWN: ''.join(vertical[y + 1:]),
-            Action.LEFT: ''.join(self.env.state[y][x-1::-1]),
-            Action.RIGHT: ''.join(self.env.state[y][x + 1:])
-        }
+        return self.env.view(self.settings.universal)
 
     def _send_reward(self) -> None:
-        if Settings.dontlearn:
+        if self.settings.dontlearn:
             return
-        self.ag.update_q_table(
-            self.state, self.next_state, self.action, self._calculate_reward())
+        next_ids = self.next_state and self.ag.encode(self.next_state)
+        reward = self._calculate_reward()
+        self.ag.update_q_table(self.state_ids, next_ids, self.action, reward)
+        if self.replay:
+            self.replay.add(self.state_ids, self.action, reward, next_ids)
+            if self.replay.added % self.settings.replay_every == 0:
+                self.replay.replay(self.ag, self.settings.replay_batch)
 
     def _request_action(self) -> Action:
-        return self.ag.select_action(self.state, self.exploitation_rate)
+        if self.settings.visual and self.settings.step_by_step:
+            self.ag.print_snake_view(self.state)
+        self.state_ids = self.ag.encode(self.state,
+                                        learn=not self.settings.dontlearn)
+        return self.ag.select_action(self.state_ids, self.exploitation_rate)
 
     def _update_stats(self) -> None:
-        if Step.state != GameState.RUNNING:
-            Step.state = GameState.RUNNING
-            Stats.round += 1
+        if self.step.state != GameState.RUNNING:
+            self.step.state = GameState.RUNNING
+            self.stats.round += 1
             snake_length = len(self.env.snake_position)
-            Stats.all_lengths.append(snake_length)
+            self.stats.add_length(snake_length)
             if snake_length < 10:
-                Step.not_ten += 1
-            if self.env.duration > Step.max_duration:
-                Step.max_duration = self.env.duration
-            if snake_length > Step.max_length:
-                Step.max_length = snake_length
-
-            self.env = Environment()
-            divider = max(Settings.sessions // 10, 1)
-            if (Stats.round % divider) == 0:
-                if not Settings.dontlearn:
+                self.step.not_ten += 1
+            if self.env.duration > self.step.max_duration:
+                self.step.max_duration = self.env.duration
+            if snake_length > self.step.max_length:
+                self.step.max_length = snake_length
+
+            if (self.stats.round % self.stats_every) == 0:
+                if not self.settings.dontlearn:
                     self.exploitation_rate += 0.1
                     self.exploitation_rate = (
                         1 if self.exploitation_rate > 0.9
                         else self.exploitation_rate)
-                Stats.update_stats()
-                Step.reset_stats()
+                self.stats.update_stats(self.step)
+                self.step.reset_stats()
+            # The next game is set up lazily by `run`, so that a checkpoint
+            # taken here resumes with the next game index.
+            self.playing = False
+            if self.on_round_end:
+                self.on_round_end(self.stats.round)
+
+    def _new_game(self) -> None:
+        seed = self.settings.seed
+        self.ag.random = game_rng(seed, 'agent', self.game)
+        if self.replay:
+            from batch_agent import game_generator
+
+            self.ag.rng = self.replay.rng = game_generator(
+                seed, 'replay', self.game)
+        rng = game_rng(seed, 'env', self.game)
+        if self.env is None:
+            board = (SparseEnvironment if self.settings.sparse
+                     else Environment)
+            self.env = board(self.settings, self.step, rng)
+        else:
+            self.env.reset(rng)
+        self.playing = True
+        self.game += 1
+        if self.seen is not None:
+            self.seen = {self.env.hash}
+            self.picks = self.ag.random_picks
+
+    def _detect_cycle(self) -> None:
+        """
+        Ends the game as a break once the board and snake repeat with no
+        random event in between: no tie-break or exploration by the agent
+        and no apple eaten, which would place a new one. The snake would
+        then go round the same loop until `LIMIT_DURATION`, so the game is
+        fast-forwarded to it and its statistics are the same.
+        """
+        if (self.current_cell in ('G', 'R')
+                or self.ag.random_picks != self.picks):
+            self.seen.clear()
+            self.picks = self.ag.random_picks
+        if self.env.hash in self.seen:
+            self.env.duration = LIMIT_DURATION + 1
+        else:
+            self.seen.add(self.env.hash)
+
+    def _render(self, visual, frames) -> bool:
+        """
+        Draws the board and waits for the delay or the next key press.
+
+        With `settings.fps`, the game isn't slowed down: only the steps
+        `frames` lets through are drawn, if the game is one of every
+        `settings.render_every`, and the keyboard is read at the same pace.
+
+        Returns:
+            bool: False if the window was closed.
+        """
+        settings = self.settings
+        if frames:
+            if not frames.due():
+                return True
+            if self.stats.round % settings.render_every == 0:
+                visual.draw_state(self.env, self.exploitation_rate)
+            return visual.catch_key_event() != KeyEvent.EXIT
+        visual.draw_state(self.env, self.exploitation_rate)
+        while True:
+            event = visual.catch_key_event()
+            if event == KeyEvent.EXIT:
+                return False
+            if event == KeyEvent.UP:
+                settings.delay /= 1.2 if settings.delay > 0.01 else 1
+            elif event == KeyEvent.DOWN:
+                settings.delay *= 1.2 if settings.delay < 2 else 1
+            if settings.step_by_step and event != KeyEvent.CONTINUE:
+                continue
+            time.sleep(settings.delay)
+            return True
+
+    def _move(self) -> None:
+        self.current_cell = self.env.move(
+            ACTION_TO_FUNCTION[self.action](self.env.snake_position[0]))
 
     def run(self):
-        action_to_function = {
-            Action.UP: Movement.move_up,
-            Action.DOWN: Movement.move_down,
-            Action.LEFT: Movement.move_left,
-            Action.RIGHT: Movement.move_right
-        }
-        if Settings.visual:
-            visual = Visualize()
-        while Stats.round != Settings.sessions:
+        if self.settings.visual:
+            from visualize import RenderScheduler, Visualize
+
+            visual = Visualize(self.settings, self.stats)
+            frames = None
+            if self.settings.fps and not self.settings.step_by_step:
+                frames = RenderScheduler(self.settings.fps)
+        settings = self.settings
+        while self.stats.round != settings.sessions:
+            if not self.playing:
+                self._new_game()
             self.state = self.next_state or self._get_snake_view()
             self.action = self._request_action()
-            if Settings.visual:
-                visual.draw_state(self.env, self.exploitation_rate)
-                while True:
-                    event = visual.catch_key_event()
-                    if event == KeyEvent.EXIT:
-                        return
-                    if event == KeyEvent.UP:
-                        Settings.delay /= 1.2 if Settings.delay > 0.01 else 1
-                    elif event == KeyEvent.DOWN:
-                        Settings.delay *= 1.2 if Settings.delay < 2 else 1
-                    if Settings.step_by_step and event != KeyEvent.CONTINUE:
-                        continue
-                    time.sleep(Settings.delay)
-                    break
-            self.current_cell = self.env.move(action_to_function[self.action](
-                self.env.snake_position[0]))
-            self.next_state = (self._get_snake_view()
-                               if Step.state == GameState.RUNNING else None)
+            if settings.visual and not self._render(visual, frames):
+                return
+            self._move()
+            self.next_state = (
+                self._get_snake_view()
+                if self.step.state == GameState.RUNNING else None)
             self._send_reward()
+            if (self.seen is not None
+                    and self.step.state == GameState.RUNNING):
+                self._detect_cycle()
             if self.env.duration > LIMIT_DURATION:
-                Step.max_break += 1
-                Step.state = GameState.LOST
+                self.step.max_break += 1
+                self.step.state = GameState.LOST
                 self.next_state = None
             self._update_stats()
@@ -1,16 +1,24 @@
 import argparse
+from array import array
+from functools import partial
+import cProfile
+import itertools
+import multiprocessing
+import os
 import random
-import statistics
+import signal
 import time
 
-from pynput import keyboard
-from matplotlib import pyplot as plt
 import yaml
+import checkpoint
+from checkpoint import parse_sessions, format_sessions
+from distributed import Learner
 from interpreter import Interpreter
+from profiler import ProfilingInterpreter
+from prune import prune
+from qtable import iter_delta, iter_json
 from utils import Settings, Stats
-from visualize import Visualize
-
-import pandas as pd
+from writer import BackgroundWriter
 
 
 def parse_arguments():
@@ -41,6 +49,20 @@ def parse_arguments():
                         the model doesn't explore")
     parser.add_argument('--dontlearn', action='store_true', help="If present, \
                         the model won't update q-table")
+    parser.add_argument('--greedy', action='store_true', help='With \
+                        --dontlearn, play with a cached greedy policy that \
+                        draws no exploration; faster, with the same policy, \
+                        but other games than the default for a seed')
+    parser.add_argument('--fps', type=int, default=0, help='In visual mode, \
+                        play at full speed and draw at most this many frames \
+                        per second instead of pausing after every move. \
+                        Default is 0, pausing.')
+    parser.add_argument('--render-every', type=int, default=1, help='With \
+                        --fps, only draw every given game. Default is 1.')
+    parser.add_argument('--no-detect-cycles', action='store_true',
+                        help="With --dontlearn, play looping games until \
+                        the duration limit instead of ending them as soon \
+                        as the loop closes; the statistics are the same")
     parser.add_argument('--step-by-step', action='store_true', help='If \
                         present, the model will wait for user input after \
                         each move')
@@ -48,44 +70,131 @@ def parse_arguments():
                         game manually')
     parser.add_argument('--universal', action='store_true', help='Train the \
                         model that would work on any board size')
+    parser.add_argument('--sparse', action='store_true', help='Store only \
+                        the snake and the apples instead of the whole \
+                        board, so that moves cost the same on any board \
+                        size; for very large boards')
+    parser.add_argument('--workers', type=int, default=1, help='Number of \
+                        processes that play the training sessions or \
+                        evaluate the loaded models in parallel. Default \
+                        is 1.')
+    parser.add_argument('--headless', action='store_true', help="If present, \
+                        don't listen to the keyboard and don't plot the \
+                        statistics, e.g. on machines without a display")
+    parser.add_argument('--checkpoint-every', type=int, default=0,
+                        help='Save the model every given number of \
+                        sessions, as the \'s\' key does. The model can also \
+                        be saved by sending SIGUSR1 to the process.')
+    parser.add_argument('--checkpoint', type=str, help='Path of a resumable \
+                        checkpoint of the training, written after every \
+                        epoch and every --checkpoint-every sessions')
+    parser.add_argument('--resume', type=str, help='Continue the training \
+                        saved in the given checkpoint, with its settings')
+    parser.add_argument('--incremental', action='store_true', help='Save \
+                        the model of every epoch as a delta against the \
+                        previous one; convert.py folds deltas into full \
+                        models')
+    parser.add_argument('--replay', type=int, default=0, help='Capacity of \
+                        an experience replay buffer; the stored transitions \
+                        are learned from again while training. Default is \
+                        0, no replay.')
+    parser.add_argument('--replay-batch', type=int, default=8,
+                        help='Number of transitions replayed at a time. \
+                        Default is 8.')
+    parser.add_argument('--replay-every', type=int, default=1, help='Number \
+                        of moves between two replays. Default is 1.')
+    parser.add_argument('--prioritized', action='store_true', help='Replay \
+                        transitions in proportion to their last TD error \
+                        instead of uniformly')
+    parser.add_argument('--prune-visits', type=int, default=0, help='After \
+                        every epoch, drop the states visited fewer times \
+                        since the start of the training')
+    parser.add_argument('--prune-value', type=float, default=0.0,
+                        help='After every epoch, drop the states whose \
+                        absolute Q-value is lower')
+    parser.add_argument('--profile', action='store_true', help='Time every \
+                        phase of the game loop and print a summary after \
+                        every epoch')
+    parser.add_argument('--cprofile', type=str, help='Run under cProfile and \
+                        dump the pstats data to the given path')
     parser.add_argument('--seed', type=int,
                         default=random.randint(0, 2**32 - 1),
                         help='Seed for random number generator')
     return parser.parse_args()
 
 
-def apply_cl_settings(args):
-    Settings.sessions = args.sessions
-    Settings.boardsize = args.boardsize
-    Settings.env_size = args.boardsize + 2
-    Settings.save_path = args.save
-    Settings.load_path = args.load
-    Settings.step_by_step = args.step_by_step
-    Settings.visual = args.visual or args.step_by_step
-    Settings.dontlearn = args.dontlearn
-    Settings.exploit = args.exploit or args.dontlearn
-    Settings.manual = args.manual
-    Settings.universal = args.universal
-    Settings.seed = args.seed
-    Settings.epochs = args.epochs
-
-
-def apply_config_settings(settings):
-    Settings.sessions = settings.get('sessions', 10)
-    Settings.boardsize = settings.get('boardsize', 10)
-    Settings.env_size = Settings.boardsize + 2
-    Settings.save_path = settings.get('save')
-    Settings.load_path = settings.get('load')
-    Settings.step_by_step = settings.get('step-by-step', False)
-    Settings.visual = settings.get('visual', False) or settings.get(
-        'step-by-step', False)
-    Settings.dontlearn = settings.get('dontlearn', False)
-    Settings.exploit = settings.get('exploit', False) or settings.get(
-        'dontlearn', False)
-    Settings.manual = settings.get('manual', False)
-    Settings.universal = settings.get('universal', False)
-    Settings.seed = settings.get('seed', random.randint(0, 2**32 - 1))
-    Settings.epochs = settings.get('epochs', 1)
+def apply_cl_settings(args) -> Settings:
+    return Settings(
+        sessions=args.sessions,
+        boardsize=args.boardsize,
+        env_size=args.boardsize + 2,
+        save_path=args.save,
+        load_path=args.load,
+        step_by_step=args.step_by_step,
+        visual=args.visual or args.step_by_step,
+        fps=args.fps,
+        render_every=args.render_every,
+        dontlearn=args.dontlearn,
+        greedy=args.greedy,
+        detect_cycles=not args.no_detect_cycles,
+        exploit=args.exploit or args.dontlearn,
+        manual=args.manual,
+        universal=args.universal,
+        sparse=args.sparse,
+        seed=args.seed,
+        epochs=args.epochs,
+        workers=args.workers,
+        headless=args.headless,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint=args.checkpoint,
+        incremental=args.incremental,
+        replay=args.replay,
+        replay_batch=args.replay_batch,
+        replay_every=args.replay_every,
+        prioritized=args.prioritized,
+        prune_visits=args.prune_visits,
+        prune_value=args.prune_value,
+        profile=args.profile,
+        cprofile=args.cprofile,
+    )
+
+
+def apply_config_settings(settings) -> Settings:
+    return Settings(
+        sessions=settings.get('sessions', 10),
+        boardsize=settings.get('boardsize', 10),
+        env_size=settings.get('boardsize', 10) + 2,
+        save_path=settings.get('save'),
+        load_path=settings.get('load'),
+        step_by_step=settings.get('step-by-step', False),
+        visual=settings.get('visual', False) or settings.get(
+            'step-by-step', False),
+        fps=settings.get('fps', 0),
+        render_every=settings.get('render-every', 1),
+        dontlearn=settings.get('dontlearn', False),
+        greedy=settings.get('greedy', False),
+        detect_cycles=settings.get('detect-cycles', True),
+        exploit=settings.get('exploit', False) or settings.get(
+            'dontlearn', False),
+        manual=settings.get('manual', False),
+        universal=settings.get('universal', False),
+        sparse=settings.get('sparse', False),
+        seed=settings.get('seed', random.randint(0, 2**32 - 1)),
+        epochs=settings.get('epochs', 1),
+        workers=settings.get('workers', 1),
+        headless=settings.get('headless', False),
+        checkpoint_every=settings.get('checkpoint-every', 0),
+        checkpoint=settings.get('checkpoint'),
+        incremental=settings.get('incremental', False),
+        replay=settings.get('replay', 0),
+        replay_batch=settings.get('replay-batch', 8),
+        replay_every=settings.get('replay-every', 1),
+        prioritized=settings.get('prioritized', False),
+        prune_visits=settings.get('prune-visits', 0),
+        prune_value=settings.get('prune-value', 0.0),
+        profile=settings.get('profile', False),
+        cprofile=settings.get('cprofile'),
+    )
 
 
 def load_config(config_path):
@@ -94,22 +203,38 @@ def load_config(config_path):
         return yaml.safe_load(file)
 
 
-def print_stats(stat_dict: dict) -> None:
+def print_stats(stat_dict: dict, plot: bool = True) -> None:
     """
-    Print the statistics.
+    Print the statistics, and plot them unless `plot` is False.
+
+    pandas and matplotlib are only imported for plotting, so headless runs
+    don't pay for them.
     """
-    df = pd.DataFrame(stat_dict)
-    if df.empty:
+    if not stat_dict['epoch']:
         print("No statistics to display.")
         return
+    if not plot:
+        columns = list(stat_dict)
+        print('  '.join(columns))
+        for row in zip(*stat_dict.values()):
+            print('  '.join(f'{value:>{len(column)}}'
+                            if not isinstance(value, float)
+                            else f'{value:>{len(column)}.2f}'
+                            for column, value in zip(columns, row)))
+        return
+    import pandas as pd
+
+    df = pd.DataFrame(stat_dict)
     print(df)
     plot_stats(df)
 
 
-def plot_stats(df: pd.DataFrame) -> None:
+def plot_stats(df) -> None:
     """
     Plot the statistics.
     """
+    from matplotlib import pyplot as plt
+
     _, ax1 = plt.subplots(figsize=(10, 6))
     ax2 = ax1.twinx()
     if any(df['model_name']):
@@ -142,94 +267,272 @@ def plot_stats(df: pd.DataFrame) -> None:
     plt.show()
 
 
-def update_stat_dict(stat_dict: dict, epoch=0, model_name='') -> None:
-    if not Stats.all_lengths:
+def update_stat_dict(stat_dict: dict, settings: Settings, stats: Stats,
+                     epoch=0, model_name='') -> None:
+    if not stats.count():
         return
     stat_dict['model_name'].append(model_name.split('/')[-1])
     stat_dict['epoch'].append(epoch)
-    stat_dict['max_length'].append(max(Stats.max_length))
-    stat_dict['median_length'].append(int(statistics.median(
-        Stats.all_lengths)))
-    stat_dict['mean_length'].append(int(statistics.mean(Stats.all_lengths)))
-    stat_dict['%_breaks'].append(Stats.breaks / Settings.sessions * 100)
-    stat_dict['%_not_ten'].append(Stats.not_ten / Settings.sessions * 100)
+    stat_dict['max_length'].append(max(stats.max_length))
+    stat_dict['median_length'].append(int(stats.median()))
+    stat_dict['mean_length'].append(int(stats.mean()))
+    stat_dict['%_breaks'].append(stats.breaks / settings.sessions * 100)
+    stat_dict['%_not_ten'].append(stats.not_ten / settings.sessions * 100)
 
 
-def train_model(stat_dict: dict):
+def train_model(settings: Settings, stat_dict: dict,
+                resume: dict | None = None):
     """
     Train the model.
+
+    Models and checkpoints are serialized by a `BackgroundWriter` from a
+    copy of the Q-table, so the game loop only pauses for the copy; the
+    writes still pending are finished before this returns. With
+    `settings.incremental` the model of every epoch is a delta against the
+    model saved or loaded before it. With `prune_visits` or `prune_value`
+    the cold states are dropped from the Q-table after every epoch.
+
+    With more than one worker the sessions of every epoch are played by
+    actor processes that feed a single learner; `profile` only applies to
+    the single-process game loop.
+
+    With `settings.checkpoint`, a resumable checkpoint is written after
+    every epoch and, in the single-process loop, every `checkpoint_every`
+    sessions and when SIGUSR1 or SIGTERM is received; SIGTERM then stops
+    the training. `resume` is a checkpoint loaded to continue from.
     """
-    play = Interpreter()
-    i = 0
-
-    def action_save(key):
-        try:
-            if key.char == 's':
-                save_path = f'{Settings.save_path or str(time.time())}' \
-                    + '_' + str(i * Settings.sessions + Stats.round)
-                play.ag.save_q_table(save_path)
-                print('\bThe model was saved as', save_path)
-        except AttributeError:
-            pass
-    listener = keyboard.Listener(on_press=action_save)
-    listener.start()
-    print("Press 's' to save the model")
-    for i in range(Settings.epochs):
-        play.run()
-        if Settings.save_path:
-            try:
-                number, exp = 0, 0
-                if Settings.load_path:
-                    number = Settings.load_path.split('/')[-1].split('_')[0]
-                    separate = number.split('k')
-                    number = int(separate[0]) * 1000 ** (len(separate) - 1)
-                number += (i + 1) * Settings.sessions
-                exp = 0
-                while number % 1000 == 0:
-                    exp += 1
-                    number //= 1000
-                save_name = f'{number}{"k" * exp}_' + Settings.save_path
-            except Exception:
-                print('Unseccessful parsing of the model name, saving with \
-                      default name')
-                save_name = Settings.save_path
-            play.ag.save_q_table(save_name)
-            update_stat_dict(stat_dict, epoch=i, model_name=save_name)
+    # A resumed Q-table comes from the checkpoint, not from the model.
+    trainer_settings = settings.replace(load_path=None) if resume \
+        else settings
+    if settings.workers > 1 and not settings.visual:
+        play = Learner(trainer_settings)
+    elif settings.profile:
+        play = ProfilingInterpreter(trainer_settings)
+    else:
+        play = Interpreter(trainer_settings)
+    try:
+        base_sessions = parse_sessions(settings.load_path)
+    except Exception:
+        base_sessions = None
+    first_epoch = 0
+    if resume:
+        checkpoint.restore(play, resume, stat_dict)
+        first_epoch = resume['epoch']
+        base_sessions = resume['base_sessions']
+        print(f'Resuming from epoch {first_epoch}, round {play.stats.round}')
+    i = first_epoch
+    played = play.stats.round
+    # Saves asked for by signals and the keyboard listener thread wait for
+    # the end of a game, when the Q-table is consistent.
+    requested = set()
+
+    # The last model saved and its values, which `incremental` saves are
+    # deltas against.
+    base = None
+    if settings.incremental and settings.load_path and not resume:
+        base = (settings.load_path, array('d', play.ag.qtable.values))
+
+    def save_model(path, message=None):
+        writer.submit(path, partial(iter_json, play.ag.qtable.snapshot()),
+                      message)
+
+    def save_epoch(path):
+        nonlocal base
+        if not settings.incremental:
+            return save_model(path)
+        table = play.ag.qtable.snapshot()
+        if base:
+            relative = os.path.relpath(base[0], os.path.dirname(path) or '.')
+            writer.submit(path, partial(iter_delta, table, base[1], relative))
         else:
-            update_stat_dict(stat_dict, epoch=i)
-        Stats.reset_stats()
-    i += 1
+            writer.submit(path, partial(iter_json, table))
+        base = (path, table.values)
+
+    def save_checkpoint():
+        save_path = f'{settings.save_path or str(time.time())}' \
+            + '_' + str(i * settings.sessions + played)
+        save_model(save_path, f'\bThe model was saved as {save_path}')
 
-    print_stats(stat_dict)
+    def write_checkpoint(epoch):
+        if settings.checkpoint:
+            checkpoint.save(settings.checkpoint, play, epoch, base_sessions,
+                            stat_dict, writer)
 
+    def on_round_end(rounds):
+        nonlocal played
+        every = settings.checkpoint_every
+        crossed = every and rounds // every > played // every
+        played = rounds
+        if crossed or 'model' in requested:
+            save_checkpoint()
+        if isinstance(play, Interpreter) and (crossed
+                                              or 'checkpoint' in requested):
+            write_checkpoint(i)
+        if 'stop' in requested:
+            print('The training was stopped after a checkpoint')
+            raise SystemExit(0)
+        requested.clear()
+
+    def on_signal(signum, _):
+        if signum == signal.SIGTERM:
+            requested.add('stop')
+        else:
+            requested.add('model')
+        if settings.checkpoint:
+            requested.add('checkpoint')
 
-def evaluate_model(stat_dict: dict):
+    play.on_round_end = on_round_end
+    play.ag.count_visits = bool(settings.prune_visits)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, on_signal)
+    if settings.checkpoint and isinstance(play, Interpreter):
+        signal.signal(signal.SIGTERM, on_signal)
+    if not settings.headless:
+        from pynput import keyboard
+
+        def action_save(key):
+            try:
+                if key.char == 's':
+                    requested.add('model')
+            except AttributeError:
+                pass
+        listener = keyboard.Listener(on_press=action_save)
+        listener.start()
+        print("Press 's' to save the model")
+    with BackgroundWriter() as writer:
+        for i in range(first_epoch, settings.epochs):
+            play.run()
+            if isinstance(play, ProfilingInterpreter):
+                print(f'Profile of epoch {i}:\n{play.report()}')
+            if settings.prune_visits or settings.prune_value:
+                states = len(play.ag.qtable)
+                play.ag.qtable = prune(play.ag.qtable, settings.prune_visits,
+                                       settings.prune_value)
+                print(f'Pruned {states - len(play.ag.qtable)} of {states} '
+                      f'states')
+                # The IDs changed, so the next model can't be a delta and
+                # the transitions to replay are lost.
+                base = None
+                if play.replay:
+                    play.replay.clear()
+            if settings.save_path:
+                if base_sessions is None:
+                    print('Unseccessful parsing of the model name, saving \
+                          with default name')
+                    save_name = settings.save_path
+                else:
+                    save_name = format_sessions(
+                        base_sessions + (i + 1) * settings.sessions) \
+                        + '_' + settings.save_path
+                save_epoch(save_name)
+                update_stat_dict(stat_dict, settings, play.stats.snapshot(),
+                                 epoch=i, model_name=save_name)
+            else:
+                update_stat_dict(stat_dict, settings, play.stats.snapshot(),
+                                 epoch=i)
+            play.stats.reset_stats()
+            played = 0
+            write_checkpoint(i + 1)
+        i += 1
+
+    print_stats(stat_dict, plot=not settings.headless)
+
+
+def evaluate_checkpoint(settings: Settings, first_game: int = 0,
+                        stats_every: int | None = None) -> Stats:
+    """
+    Evaluate one model, or the games from `first_game` on of a shard of
+    its sessions, and return the statistics.
+    """
+    random.seed(settings.seed)
+    if settings.profile:
+        play = ProfilingInterpreter(settings)
+    else:
+        play = Interpreter(settings)
+    play.game = first_game
+    play.stats_every = stats_every or play.stats_every
+    play.run()
+    if settings.profile:
+        print(f'Profile of {settings.load_path}:\n{play.report()}')
+    if settings.save_path:
+        play.ag.save_q_table(settings.save_path)
+    return play.stats.snapshot()
+
+
+def shard_sessions(sessions: int, shards: int, block: int) -> list:
+    """
+    Splits the games of an evaluation into ranges that start on multiples
+    of `block`, so that every shard adds its records to the statistics
+    after the same games as a single run would.
+
+    Returns:
+        list[tuple]: (first game, number of games) of every shard.
+    """
+    blocks = max(sessions // block, 1)
+    shards = max(min(shards, blocks), 1)
+    ranges = []
+    first = 0
+    for shard in range(shards):
+        games = (blocks // shards + (shard < blocks % shards)) * block
+        if shard == shards - 1:
+            games = sessions - first
+        ranges.append((first, games))
+        first += games
+    return ranges
+
+
+def evaluate_model(settings: Settings, stat_dict: dict):
     """
     Evaluate the model.
+
+    With more than one worker the models are evaluated in a process pool.
+    Every game draws from random streams derived from the seed and its
+    index, so when the models don't learn, the sessions of a model are
+    also split among the workers that the models leave idle. Either way
+    the statistics are the same as those of a serial run.
     """
-    if type(Settings.load_path) is not list:
-        Settings.load_path = [Settings.load_path]
-    load_paths = Settings.load_path
+    load_paths = settings.load_path
+    if type(load_paths) is not list:
+        load_paths = [load_paths]
+    workers = settings.workers or 1
+    if settings.visual:
+        workers = 1
+    per_model = 1
+    if settings.dontlearn and not settings.save_path:
+        per_model = max(workers // len(load_paths), 1)
+    block = max(settings.sessions // 10, 1)
+    runs = []
     for path in load_paths:
-        random.seed(Settings.seed)
-        Settings.load_path = path
-        play = Interpreter()
-        play.run()
-        if Settings.save_path:
-            play.ag.save_q_table(Settings.save_path)
-        update_stat_dict(stat_dict, model_name=path)
-        Stats.reset_stats()
-    print_stats(stat_dict)
+        for first, games in shard_sessions(settings.sessions, per_model,
+                                           block):
+            runs.append((settings.replace(load_path=path, sessions=games),
+                         first, block))
+    workers = min(workers, len(runs))
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(evaluate_checkpoint, runs, chunksize=1)
+    else:
+        results = itertools.starmap(evaluate_checkpoint, runs)
+    results = iter(results)
+    for path in load_paths:
+        stats = Stats()
+        for _ in range(len(runs) // len(load_paths)):
+            stats.merge(next(results))
+        update_stat_dict(stat_dict, settings, stats, model_name=path)
+    print_stats(stat_dict, plot=not settings.headless)
 
 
 def main():
     args = parse_arguments()
-    if args.config:
-        settings = load_config(args.config)
-        apply_config_settings(settings)
+    resume = None
+    if args.resume:
+        resume = checkpoint.load(args.resume)
+        settings = resume['settings']
+    elif args.config:
+        settings = apply_config_settings(load_config(args.config))
     else:
-        apply_cl_settings(args)
-    random.seed(Settings.seed)
+        settings = apply_cl_settings(args)
+    random.seed(settings.seed)
     stat_dict = {
         'model_name': [],
         'epoch': [],
@@ -239,17 +542,27 @@ def main():
         '%_breaks': [],
         '%_not_ten': []
     }
+    profiler = cProfile.Profile() if settings.cprofile else None
+    if profiler:
+        profiler.enable()
     try:
-        if Settings.manual:
-            play = Visualize()
+        if settings.manual:
+            from visualize import Visualize
+
+            play = Visualize(settings)
             play.run()
         else:
-            if Settings.save_path or not Settings.load_path:
-                train_model(stat_dict)
-            elif Settings.load_path:
-                evaluate_model(stat_dict)
+            if resume or settings.save_path or not settings.load_path:
+                train_model(settings, stat_dict, resume)
+            elif settings.load_path:
+                evaluate_model(settings, stat_dict)
     except KeyboardInterrupt:
         print()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(settings.cprofile)
+            print('The cProfile data was saved as', settings.cprofile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+import statistics
+import time
+from collections import Counter
+
+from interpreter import Interpreter
+from utils import GameState
+
+# Phases of a step, in the order `Interpreter.run` goes through them.
+PHASES = ['reset', 'view', 'select_action', 'render', 'move', 'reward',
+          'cycle', 'stats']
+
+
+class Profile:
+    """
+    Wall time and call counts per phase of the game loop, plus the growth
+    of the Q-table and the distribution of game durations.
+
+    Attributes:
+        time (dict): Seconds spent in every phase.
+        calls (dict): Number of calls of every phase.
+        wall (float): Seconds spent in `Interpreter.run`.
+        games (int): Number of finished games.
+        durations (Counter): Number of games per number of steps.
+        growth (list[tuple]): (sessions, Q-table size) every 1000 sessions.
+    """
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.time = dict.fromkeys(PHASES, 0.0)
+        self.calls = dict.fromkeys(PHASES, 0)
+        self.wall = 0.0
+        self.games = 0
+        self.durations = Counter()
+        self.growth = []
+
+    def summary(self) -> str:
+        lines = [f'{"phase":<14}{"calls":>10}{"total s":>10}'
+                 f'{"us/call":>10}{"share":>8}']
+        for phase in PHASES:
+            calls, spent = self.calls[phase], self.time[phase]
+            if not calls:
+                continue
+            lines.append(f'{phase:<14}{calls:>10}{spent:>10.3f}'
+                         f'{spent / calls * 1e6:>10.2f}'
+                         f'{spent / (self.wall or 1) * 100:>7.1f}%')
+        other = self.wall - sum(self.time.values())
+        lines.append(f'{"other":<14}{"":>10}{other:>10.3f}{"":>10}'
+                     f'{other / (self.wall or 1) * 100:>7.1f}%')
+        lines.append(f'{"total":<14}{"":>10}{self.wall:>10.3f}')
+        games = self.games
+        if games:
+            total = sum(d * n for d, n in self.durations.items())
+            low, high, p90 = ranked(self.durations, [
+                (games - 1) // 2, games // 2, int((games - 1) * 0.9)])
+            lines.append(
+                f'Steps per session: mean {total / games:.1f}, '
+                f'median {(low + high) / 2:.0f}, '
+                f'p90 {p90}, max {max(self.durations)} '
+                f'({games / (self.wall or 1):.0f} sessions/s, '
+                f'{total / (self.wall or 1):.0f} steps/s)')
+        if len(self.growth) > 1:
+            new = [b[1] - a[1] for a, b in zip(self.growth, self.growth[1:])]
+            lines.append(
+                f'Q-table growth: {statistics.mean(new):.0f} new states per '
+                f'1k sessions, {new[-1]} in the last 1k, '
+                f'{self.growth[-1][1]} states')
+        return '\n'.join(lines)
+
+
+def ranked(histogram: Counter, ranks: list) -> list:
+    """
+    Returns the values at the given 0-based ranks of the sorted values of a
+    histogram, walking its counts instead of expanding it.
+
+    Args:
+        histogram (Counter): Number of occurrences of every value.
+        ranks (list[int]): Ranks lower than the number of values.
+    """
+    order = sorted(range(len(ranks)), key=ranks.__getitem__)
+    values = [None] * len(ranks)
+    seen = 0
+    for value, count in sorted(histogram.items()):
+        seen += count
+        while order and ranks[order[0]] < seen:
+            values[order.pop(0)] = value
+    return values
+
+
+def timed(phase: str, method):
+    """
+    Wraps an interpreter method so that its calls are added to `phase`.
+    """
+    def wrapper(self, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            self.profile.time[phase] += time.perf_counter() - start
+            self.profile.calls[phase] += 1
+    return wrapper
+
+
+class ProfilingInterpreter(Interpreter):
+    """
+    An interpreter that records a `Profile` of the game loop.
+
+    Every phase of `Interpreter.run` is a method, so timing it costs one
+    wrapper call per phase and a plain `Interpreter` pays nothing.
+    """
+    _new_game = timed('reset', Interpreter._new_game)
+    _get_snake_view = timed('view', Interpreter._get_snake_view)
+    _request_action = timed('select_action', Interpreter._request_action)
+    _render = timed('render', Interpreter._render)
+    _move = timed('move', Interpreter._move)
+    _send_reward = timed('reward', Interpreter._send_reward)
+    _detect_cycle = timed('cycle', Interpreter._detect_cycle)
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.profile = Profile()
+        super().__init__(*args, **kwargs)
+        self.profile.growth.append((0, len(self.ag.qtable)))
+
+    def report(self) -> str:
+        """
+        Returns the summary of the profile and starts a new one.
+        """
+        summary = self.profile.summary()
+        self.profile.reset()
+        self.profile.growth.append((0, len(self.ag.qtable)))
+        return summary
+
+    def _update_stats(self) -> None:
+        if self.step.state != GameState.RUNNING:
+            profile = self.profile
+            profile.durations[self.env.duration] += 1
+            profile.games += 1
+            if profile.games % 1000 == 0:
+                profile.growth.append((profile.games, len(self.ag.qtable)))
+        super()._update_stats()
+
+    _update_stats = timed('stats', _update_stats)
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            return super().run()
+        finally:
+            self.profile.wall += time.perf_counter() - start
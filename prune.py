@@ -0,0 +1,171 @@
+import argparse
+import random
+from collections import defaultdict
+
+from environment import squash
+from interpreter import Interpreter
+from qtable import QTable, iter_json, load
+from utils import Settings, Stats, atomic_write
+
+
+def parse_arguments():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Shrink a model by dropping the states it rarely or \
+        never uses, and report how its play changes.")
+    parser.add_argument('path', help='Path of the model to prune')
+    parser.add_argument('--output', type=str, help='Path of the pruned \
+                        model. Default is the path with a .pruned suffix.')
+    parser.add_argument('--min-visits', type=int, default=1, help='Drop the \
+                        states looked up fewer times than this while the \
+                        model plays --sessions games. Default is 1.')
+    parser.add_argument('--min-value', type=float, default=0.0, help='Drop \
+                        the states whose absolute Q-value is lower than \
+                        this. Default is 0.')
+    parser.add_argument('--merge-universal', action='store_true',
+                        help='Merge the states that are the same in the \
+                        universal encoding; the result is a universal model')
+    parser.add_argument('--universal', action='store_true', help='The model \
+                        is a universal one')
+    parser.add_argument('--boardsize', type=int, default=10, help='The size \
+                        of the board to play on. Default is 10.')
+    parser.add_argument('--sessions', type=int, default=1000, help='Number \
+                        of games played to count the visits, and again to \
+                        compare the models. Default is 1000.')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for random number generator')
+    return parser.parse_args()
+
+
+def prune(table: QTable, min_visits: int = 0, min_value: float = 0.0
+          ) -> QTable:
+    """
+    Drops the states visited fewer than `min_visits` times or with an
+    absolute Q-value lower than `min_value`.
+
+    Note that the agent never picks a direction whose view is not in the
+    Q-table unless it knows none of them, so dropping a state can change
+    its decisions.
+
+    Args:
+        table (QTable): The Q-table, with its visit counts.
+        min_visits (int): Visits needed to keep a state.
+        min_value (float): Absolute Q-value needed to keep a state.
+
+    Returns:
+        QTable: A new table with the states that are kept, in ID order.
+    """
+    pruned = QTable()
+    for key, value, visits in zip(table.keys, table.values, table.visits):
+        if visits >= min_visits and abs(value) >= min_value:
+            pruned.ids[key] = len(pruned.keys)
+            pruned.keys.append(key)
+            pruned.values.append(value)
+            pruned.visits.append(visits)
+    return pruned
+
+
+def merge_universal(table: QTable) -> QTable:
+    """
+    Merges the states whose views are the same once squashed, as in
+    universal models. The Q-value of a merged state is the mean of the
+    merged ones weighted by their visits, or the plain mean when none of
+    them was visited.
+
+    Args:
+        table (QTable): The Q-table, with its visit counts.
+
+    Returns:
+        QTable: A universal Q-table.
+    """
+    groups = defaultdict(list)
+    for key, value, visits in zip(table.keys, table.values, table.visits):
+        groups[squash(key)].append((value, visits))
+    merged = QTable()
+    for key, entries in groups.items():
+        visits = sum(v for _, v in entries)
+        if visits:
+            value = sum(q * v for q, v in entries) / visits
+        else:
+            value = sum(q for q, _ in entries) / len(entries)
+        merged.ids[key] = len(merged.keys)
+        merged.keys.append(key)
+        merged.values.append(value)
+        merged.visits.append(visits)
+    return merged
+
+
+def evaluate(table: QTable, settings: Settings, count_visits: bool = False
+             ) -> Stats:
+    """
+    Plays the sessions of `settings` with a model without learning.
+
+    Args:
+        table (QTable): The Q-table to play with.
+        settings (Settings): The configuration of the games.
+        count_visits (bool): Whether to count the visits of the states in
+            `table.visits`.
+
+    Returns:
+        Stats: The statistics of the games.
+    """
+    random.seed(settings.seed)
+    play = Interpreter(settings)
+    play.ag.qtable = table
+    play.ag.count_visits = count_visits
+    play.run()
+    return play.stats
+
+
+def report(rows: list) -> str:
+    """
+    Formats the comparison of the models as a table.
+
+    Args:
+        rows (list[tuple]): (name, states, size of the JSON model, Stats)
+            of every model.
+    """
+    lines = [f'{"model":<10}{"states":>10}{"bytes":>12}{"mean":>8}'
+             f'{"median":>8}{"max":>6}{"%breaks":>9}{"%not_ten":>10}']
+    for name, states, size, stats in rows:
+        lines.append(f'{name:<10}{states:>10}{size:>12}{stats.mean():>8.2f}'
+                     f'{stats.median():>8.1f}{stats.longest:>6}'
+                     f'{stats.breaks / stats.round * 100:>9.2f}'
+                     f'{stats.not_ten / stats.round * 100:>10.2f}')
+    return '\n'.join(lines)
+
+
+def main():
+    args = parse_arguments()
+    output = args.output or args.path + '.pruned'
+    settings = Settings(boardsize=args.boardsize,
+                        env_size=args.boardsize + 2,
+                        sessions=args.sessions, universal=args.universal,
+                        dontlearn=True, exploit=True, headless=True,
+                        seed=args.seed)
+    table = load(args.path)
+    evaluate(table, settings, count_visits=True)
+    pruned = prune(table, args.min_visits, args.min_value)
+    if args.merge_universal:
+        pruned = merge_universal(pruned)
+    encoded = b''.join(iter_json(pruned))
+    atomic_write(output, encoded)
+
+    # Compare the models on games other than the ones that counted visits.
+    compared = settings.replace(seed=args.seed + 1)
+    rows = [('original', len(table), len(b''.join(iter_json(table))),
+             evaluate(table, compared))]
+    compared = compared.replace(universal=(args.universal
+                                           or args.merge_universal))
+    rows.append(('pruned', len(pruned), len(encoded),
+                 evaluate(pruned, compared)))
+    print(report(rows))
+    print(f'{len(table) - len(pruned)} of {len(table)} states dropped '
+          f'({(1 - len(pruned) / (len(table) or 1)) * 100:.1f}%), '
+          f'the model was saved as {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+from array import array
+import bisect
+import itertools
+import json
+import mmap
+import os
+import struct
+
+# Binary model layout, in native (little-endian) byte order:
+#   header   magic, version, reserved, number of keys n, key blob size
+#   offsets  n + 1 uint64 offsets of the keys in the blob
+#   values   n float64 Q-values, in key order
+#   blob     the UTF-8 keys sorted bytewise and concatenated
+MAGIC = b'QTBL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ')
+# Number of entries `iter_json` encodes at a time.
+JSON_CHUNK = 20000
+# Delta models are JSON objects whose first member describes the delta:
+#   {"qtable-delta": {"version": 1, "base": path}, "values": {view: value}}
+# with the path of the base model relative to the directory of the delta.
+DELTA_PREFIX = b'{"qtable-delta": '
+DELTA_VERSION = 1
+
+
+class QTable:
+    """
+    A Q-table that interns every view string into a dense integer ID.
+
+    Each key is hashed once, when it is first seen; after that the agent
+    works with the integer IDs, and the Q-values live unboxed in one
+    contiguous `array('d')` indexed by ID.
+
+    Attributes:
+        ids (dict): Maps view strings to their IDs.
+        keys (list[str]): Maps IDs back to view strings.
+        values (array): Q-value of every ID.
+        visits (array): Number of decisions every ID was looked up for,
+            when the agent counts them (see `Agent.count_visits`). Visits
+            are not part of the model files.
+
+    Methods:
+        intern(key: str) -> int:
+            Returns the ID of a key, adding it with a Q-value of 0 if new.
+        get_id(key: str) -> int:
+            Returns the ID of a key or -1 if it is not in the table.
+        to_dict() -> dict:
+            Returns the table as a {view: Q-value} dictionary.
+        snapshot() -> QTableSnapshot:
+            Returns a read-only copy of the table to save in the background.
+        from_dict(table: dict) -> QTable:
+            Builds a table from a {view: Q-value} dictionary.
+    """
+    def __init__(self) -> None:
+        self.ids = dict()
+        self.keys = []
+        self.values = array('d')
+        self.visits = array('L')
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.ids
+
+    def __getitem__(self, key: str) -> float:
+        return self.values[self.ids[key]]
+
+    def __setitem__(self, key: str, value: float) -> None:
+        self.values[self.intern(key)] = value
+
+    def intern(self, key: str) -> int:
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.values.append(0.0)
+            self.visits.append(0)
+        return i
+
+    def get_id(self, key: str) -> int:
+        return self.ids.get(key, -1)
+
+    def items(self):
+        return zip(self.keys, self.values)
+
+    def copy(self) -> 'QTable':
+        table = QTable()
+        table.ids = self.ids.copy()
+        table.keys = self.keys.copy()
+        table.values = array('d', self.values)
+        table.visits = array('L', self.visits)
+        return table
+
+    def snapshot(self) -> 'QTableSnapshot':
+        return QTableSnapshot(self)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    @classmethod
+    def from_dict(cls, table: dict) -> 'QTable':
+        qtable = cls()
+        qtable.keys = list(table)
+        qtable.ids = {key: i for i, key in enumerate(qtable.keys)}
+        qtable.values = array('d', table.values())
+        qtable.visits = array('L', bytes(qtable.visits.itemsize
+                                         * len(qtable.keys)))
+        return qtable
+
+
+class QTableSnapshot:
+    """
+    The entries of a `QTable` at one point, for a background write while
+    the game loop goes on changing the table.
+
+    Keys are only ever appended to a table, so the snapshot shares the
+    `keys` list and remembers how many of them there were; only the
+    `values` and `visits` arrays are copied, and the `ids` dict isn't.
+
+    Attributes:
+        keys (list[str]): The `keys` list of the table, which may have
+            grown since; only the first `len(values)` are in the snapshot.
+        values (array): Q-value of every ID at the time of the snapshot.
+        visits (array): Visits of every ID at the time of the snapshot.
+    """
+    def __init__(self, table: QTable) -> None:
+        self.keys = table.keys
+        self.values = array('d', table.values)
+        self.visits = array('L', table.visits)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def items(self):
+        return zip(self.keys, self.values)
+
+
+class MappedQTable:
+    """
+    A read-only Q-table backed by a memory-mapped binary model file.
+
+    Nothing is parsed up front: the ID of a key is its position in the
+    sorted key blob, found by binary search, and `values` is a view of the
+    float64 array in the file. Only the pages that are actually touched
+    are read from disk, which makes it cheap to evaluate many checkpoints.
+
+    Attributes:
+        values (memoryview): Q-value of every ID.
+    """
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, n, _ = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a binary Q-table')
+        if version != VERSION:
+            raise ValueError(f'Unsupported Q-table version {version}')
+        view = memoryview(self._mm)
+        start = HEADER.size
+        self._offsets = view[start:start + 8 * (n + 1)].cast('Q')
+        start += 8 * (n + 1)
+        self.values = view[start:start + 8 * n].cast('d')
+        self._blob = view[start + 8 * n:]
+        self._n = n
+        self._ids = dict()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __contains__(self, key: str) -> bool:
+        return self.get_id(key) >= 0
+
+    def __getitem__(self, key: str) -> float:
+        i = self.get_id(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.values[i]
+
+    def key(self, i: int) -> str:
+        return self._key_bytes(i).decode()
+
+    def get_id(self, key: str) -> int:
+        i = self._ids.get(key)
+        if i is None:
+            encoded = key.encode()
+            i = bisect.bisect_left(range(self._n), encoded,
+                                   key=self._key_bytes)
+            if i == self._n or self._key_bytes(i) != encoded:
+                i = -1
+            self._ids[key] = i
+        return i
+
+    def items(self):
+        return ((self.key(i), self.values[i]) for i in range(self._n))
+
+    def copy(self) -> QTable:
+        return QTable.from_dict(self.to_dict())
+
+    def snapshot(self) -> QTable:
+        return self.copy()
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def close(self) -> None:
+        self._offsets.release()
+        self.values.release()
+        self._blob.release()
+        self._mm.close()
+
+    def _key_bytes(self, i: int) -> bytes:
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])
+
+
+def is_binary(path: str) -> bool:
+    """
+    Checks whether a model file is in the binary format.
+
+    Args:
+        path (str): The path of the model file.
+
+    Returns:
+        bool: True for binary models, False for JSON ones.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def is_delta(path: str) -> bool:
+    """
+    Checks whether a model file is a delta against another model.
+
+    Args:
+        path (str): The path of the model file.
+
+    Returns:
+        bool: True for delta models.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(DELTA_PREFIX)) == DELTA_PREFIX
+
+
+def load(path: str, read_only: bool = False) -> QTable | MappedQTable:
+    """
+    Loads a model in any format: JSON, binary or a chain of deltas ending
+    in a model of either format.
+
+    Args:
+        path (str): The path of the model file.
+        read_only (bool): If True, a binary model is memory-mapped instead
+            of being read into memory; deltas are always read.
+
+    Returns:
+        QTable | MappedQTable: The Q-table.
+    """
+    deltas = []
+    seen = set()
+    while is_delta(path):
+        if path in seen:
+            raise ValueError(f'{path} is part of a cycle of deltas')
+        seen.add(path)
+        with open(path, 'r') as f:
+            delta = json.load(f)
+        header = delta['qtable-delta']
+        if header['version'] != DELTA_VERSION:
+            raise ValueError(f'Unsupported delta version {header["version"]}')
+        deltas.append(delta['values'])
+        path = os.path.join(os.path.dirname(path), header['base'])
+    if is_binary(path):
+        table = MappedQTable(path)
+        if not read_only or deltas:
+            table = table.copy()
+    else:
+        with open(path, 'r') as f:
+            table = QTable.from_dict(json.load(f))
+    for values in reversed(deltas):
+        for key, value in values.items():
+            table[key] = value
+    return table
+
+
+def save_binary(table, path: str) -> None:
+    """
+    Writes a Q-table in the binary model format.
+
+    Args:
+        table (QTable | MappedQTable | dict): The Q-table to save.
+        path (str): The path of the model file.
+    """
+    pairs = sorted((key.encode(), value) for key, value in table.items())
+    offsets = array('Q', [0])
+    for key, _ in pairs:
+        offsets.append(offsets[-1] + len(key))
+    values = array('d', (value for _, value in pairs))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(pairs), offsets[-1]))
+        f.write(offsets.tobytes())
+        f.write(values.tobytes())
+        f.write(b''.join(key for key, _ in pairs))
+
+
+def iter_json(table, indent: int | None = None):
+    """
+    Encodes a Q-table as a JSON object, a chunk of entries at a time.
+
+    Without `indent` the output is the same as `json.dumps(table)`, but
+    since the encoder only runs on `JSON_CHUNK` entries at a time, other
+    threads get to run in between when it's used in the background.
+
+    Args:
+        table (QTable | QTableSnapshot | MappedQTable | dict): The Q-table
+            to encode.
+        indent (int | None): Indentation for a pretty-printed export, as
+            for `json.dumps`. Pretty-printing is much slower.
+
+    Yields:
+        bytes: Consecutive parts of the UTF-8 JSON document.
+    """
+    if indent is not None:
+        yield json.dumps(dict(table.items()), indent=indent).encode()
+        return
+    items = iter(table.items())
+    yield b'{'
+    separator = b''
+    while chunk := dict(itertools.islice(items, JSON_CHUNK)):
+        yield separator + json.dumps(chunk)[1:-1].encode()
+        separator = b', '
+    yield b'}'
+
+
+def iter_delta(table: QTable | QTableSnapshot, base_values, base: str):
+    """
+    Encodes the entries of a Q-table that were added or changed since a
+    base model was saved.
+
+    IDs are only ever appended, so the entries of the base are the first
+    `len(base_values)` IDs of the table.
+
+    Args:
+        table (QTable | QTableSnapshot): The Q-table to encode.
+        base_values (array): The values of the table when the base model
+            was saved.
+        base (str): The path of the base model, relative to the directory
+            of the delta.
+
+    Yields:
+        bytes: Consecutive parts of the delta model.
+    """
+    n = len(base_values)
+    changed = {key: value for key, value, old
+               in zip(table.keys, table.values, base_values) if value != old}
+    changed.update(zip(itertools.islice(table.keys, n, None),
+                       table.values[n:]))
+    yield (DELTA_PREFIX
+           + json.dumps({'version': DELTA_VERSION, 'base': base}).encode()
+           + b', "values": ')
+    yield from iter_json(changed)
+    yield b'}'
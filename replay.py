@@ -0,0 +1,200 @@
+import base64
+from array import array
+
+import numpy as np
+
+from batch_agent import BatchAgent
+from utils import Action
+
+# Prioritized sampling: priorities are |TD error| ** ALPHA, and the updates
+# are scaled by importance-sampling weights (N * P(i)) ** -BETA.
+ALPHA = 0.6
+BETA = 0.4
+# New transitions get the highest priority so far, and at least this one.
+MIN_PRIORITY = 1.0
+
+
+class ReplayBuffer:
+    """
+    A fixed-capacity ring buffer of transitions for experience replay.
+
+    Transitions are packed into NumPy arrays, so the memory used is fixed
+    when the buffer is created, about 40 bytes per transition: the Q-table
+    IDs of the state and of the next state in the order of `Action` (-1
+    for views that were unknown), the `Action.value` of the move, the
+    reward and whether the game ended. Once full, the oldest transitions
+    are overwritten.
+
+    With prioritized sampling the priorities are the leaves of a sum tree,
+    a packed array in which every node holds the sum of its two children
+    and the root the total, so updating priorities and sampling a batch
+    cost O(log capacity) per transition instead of a pass over the buffer.
+
+    Attributes:
+        capacity (int): Maximum number of transitions.
+        size (int): Number of transitions stored.
+        added (int): Number of transitions ever added.
+        prioritized (bool): Whether transitions are sampled in proportion
+            to their last TD error instead of uniformly.
+
+    Methods:
+        add(state: dict, action: Action, reward: int, next_state: dict |
+                None) -> None:
+            Stores a transition.
+        sample(n: int) -> np.ndarray:
+            Picks the indices of n stored transitions.
+        replay(agent: BatchAgent, n: int) -> None:
+            Applies the Bellman updates of n sampled transitions.
+        clear() -> None:
+            Drops every transition, e.g. when the Q-table IDs changed.
+        get_state() -> dict:
+            Returns the transitions and counters, e.g. for a checkpoint.
+        set_state(state: dict) -> None:
+            Puts back what `get_state` returned.
+    """
+    def __init__(self, capacity: int, prioritized: bool = False,
+                 rng: np.random.Generator | None = None) -> None:
+        self.capacity = capacity
+        self.prioritized = prioritized
+        self.rng = rng or np.random.default_rng()
+        self.size = 0
+        self.added = 0
+        self.states = np.empty((capacity, len(Action)), dtype=np.int32)
+        self.next_states = np.empty((capacity, len(Action)), dtype=np.int32)
+        self.actions = np.empty(capacity, dtype=np.int8)
+        self.rewards = np.empty(capacity, dtype=np.int16)
+        self.done = np.empty(capacity, dtype=bool)
+        if prioritized:
+            # Node i has children 2i and 2i + 1; leaf j is node leaves + j.
+            self.leaves = 1 << max(capacity - 1, 1).bit_length()
+            self.tree = array('d', bytes(16 * self.leaves))
+            self.max_priority = MIN_PRIORITY
+
+    def add(self, state: dict, action: Action, reward: int,
+            next_state: dict | None) -> None:
+        """
+        Stores a transition, as passed to `Agent.update_q_table`.
+        """
+        i = self.added % self.capacity
+        self.states[i] = [state[a] for a in Action]
+        if next_state:
+            self.next_states[i] = [next_state[a] for a in Action]
+        self.actions[i] = action.value
+        self.rewards[i] = reward
+        self.done[i] = not next_state
+        if self.prioritized:
+            self._set_priority(i, self.max_priority)
+        self.added += 1
+        self.size = min(self.size + 1, self.capacity)
+
+    def clear(self) -> None:
+        self.size = 0
+        self.added = 0
+        if self.prioritized:
+            self.tree = array('d', bytes(16 * self.leaves))
+            self.max_priority = MIN_PRIORITY
+
+    def get_state(self) -> dict:
+        """
+        Returns the stored transitions, their priorities and the counters,
+        with the arrays as base64 strings so that the state can go in JSON.
+        """
+        n = self.size
+        arrays = {'states': self.states, 'next_states': self.next_states,
+                  'actions': self.actions, 'rewards': self.rewards,
+                  'done': self.done}
+        if self.prioritized:
+            arrays['priorities'] = np.frombuffer(
+                self.tree)[self.leaves:]
+        state = {name: base64.b64encode(values[:n].tobytes()).decode()
+                 for name, values in arrays.items()}
+        state.update(size=n, added=self.added)
+        if self.prioritized:
+            state['max_priority'] = self.max_priority
+        return state
+
+    def set_state(self, state: dict) -> None:
+        """
+        Puts back the transitions of a buffer of the same kind and
+        capacity, as returned by `get_state`.
+        """
+        self.clear()
+        n = self.size = state['size']
+        self.added = state['added']
+        for name in ('states', 'next_states', 'actions', 'rewards', 'done'):
+            values = getattr(self, name)
+            values[:n] = np.frombuffer(base64.b64decode(state[name]),
+                                       dtype=values.dtype
+                                       ).reshape((n,) + values.shape[1:])
+        if self.prioritized:
+            priorities = np.frombuffer(base64.b64decode(state['priorities']))
+            for i, priority in enumerate(priorities.tolist()):
+                self._set_priority(i, priority)
+            self.max_priority = state['max_priority']
+
+    def sample(self, n: int) -> np.ndarray:
+        """
+        Picks stored transitions at random, with replacement.
+
+        Args:
+            n (int): The number of transitions.
+
+        Returns:
+            np.ndarray: Their indices in the buffer.
+        """
+        if not self.prioritized:
+            return self.rng.integers(0, self.size, n)
+        tree = self.tree
+        leaves = self.leaves
+        picked = []
+        for pick in (self.rng.random(n) * tree[1]).tolist():
+            node = 1
+            while node < leaves:
+                node *= 2
+                if pick >= tree[node]:
+                    pick -= tree[node]
+                    node += 1
+            # Rounding can lead past the last stored transition.
+            picked.append(min(node - leaves, self.size - 1))
+        return np.array(picked)
+
+    def replay(self, agent: BatchAgent, n: int) -> None:
+        """
+        Applies the Bellman updates of n sampled transitions to the
+        Q-table of the agent, and with prioritized sampling updates their
+        priorities with the new TD errors.
+
+        Args:
+            agent (BatchAgent): The agent that learns.
+            n (int): The number of transitions.
+        """
+        if not self.size:
+            return
+        picked = self.sample(n)
+        weights = None
+        if self.prioritized:
+            p = (np.frombuffer(self.tree)[self.leaves + picked]
+                 / self.tree[1])
+            weights = (self.size * p) ** -BETA
+            weights /= weights.max()
+        errors = agent.update_q_tables(
+            self.states[picked], self.next_states[picked],
+            self.actions[picked], self.rewards[picked], self.done[picked],
+            weights)
+        if self.prioritized:
+            priorities = np.abs(errors) ** ALPHA + 1e-6
+            for i, priority in zip(picked.tolist(), priorities.tolist()):
+                self._set_priority(i, priority)
+            self.max_priority = max(self.max_priority, priorities.max())
+
+    def _set_priority(self, i: int, priority: float) -> None:
+        """
+        Sets the priority of a transition and the sums above it.
+        """
+        tree = self.tree
+        node = i + self.leaves
+        tree[node] = priority
+        node //= 2
+        while node:
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+            node //= 2
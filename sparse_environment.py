@@ -0,0 +1,370 @@
+import random
+from bisect import bisect_left, insort
+from collections import deque
+
+from environment import DIRECTIONS, squash
+from utils import Action, GameState, Movement, Position, Settings, Step
+
+MASK = (1 << 64) - 1
+# Code of every cell type in the keys of `_key`.
+CODES = {letter: code for code, letter in enumerate('0WSHGR')}
+
+
+def _key(n: int) -> int:
+    """
+    A 64-bit Zobrist key for any feature number, from the splitmix64 mixer,
+    since a table of keys for every cell of a huge board would not fit.
+    """
+    n = (n + 0x9E3779B97F4A7C15) & MASK
+    n = ((n ^ (n >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    n = ((n ^ (n >> 27)) * 0x94D049BB133111EB) & MASK
+    return n ^ (n >> 31)
+
+
+class SparseEnvironment:
+    """
+    A snake board that only stores what is on it, for boards too large for
+    the grid of `Environment`.
+
+    The cells that are neither empty nor walls are kept in a dict, plus the
+    sorted coordinates of those cells in every row and column, and the
+    snake is a deque. Walls are only the border, so they are known from the
+    coordinates. A move and a view then cost in the length of the snake and
+    the number of apples rather than in the area or side of the board.
+
+    The rules and the view are those of `Environment`. Empty cells are
+    drawn by rejection sampling on mostly empty boards, so the games played
+    for a seed are not the same as with `Environment`.
+
+    Attributes:
+        settings (Settings): The configuration of the run.
+        step (Step): The state of the game, set to LOST or WON when the
+            game ends.
+        size (int): Side of the board including walls.
+        cells (dict): {y * size + x: letter} of the snake and apple cells.
+        rows (dict): {y: sorted x of the cells of `cells` in row y}.
+        columns (dict): {x: sorted y of the cells of `cells` in column x}.
+        snake_position (deque[Position]): Snake cells from head to tail.
+        duration (int): Number of moves made in the current game.
+        version (int): Number of moves and resets of the board; `dirty`
+            holds the changes from the previous version to this one.
+        dirty (list | None): (x, y, letter) of every cell write of the last
+            move, in order, or None after `reset`, as in `Environment`.
+        rng (random.Random): Source of the placement of the snake and the
+            apples, or the `random` module.
+        hash (int): Zobrist hash of the cells and of the order of the snake
+            segments, as in `Environment`; the keys differ.
+
+    Methods:
+        move(p: Position) -> str:
+            Moves the snake head to a cell.
+        reset(rng: random.Random | None) -> None:
+            Sets up a new game on the same board.
+        view(universal: bool) -> dict:
+            Returns what the snake sees in every direction.
+    """
+    def __init__(self, settings: Settings, step: Step,
+                 rng: random.Random | None = None) -> None:
+        self.settings = settings
+        self.step = step
+        self.size = settings.env_size
+        self.cells = {}
+        self.rows = {}
+        self.columns = {}
+        self.snake_position = deque()
+        self.version = 0
+        self.reset(rng)
+
+    @property
+    def state(self) -> list:
+        """
+        The board as rows of one-character cell strings, as in
+        `Environment`, e.g. to draw it; built on every access.
+        """
+        size = self.size
+        state = [['W'] * size] + [['W'] + ['0'] * (size - 2) + ['W']
+                                  for _ in range(size - 2)] + [['W'] * size]
+        for i, letter in self.cells.items():
+            y, x = divmod(i, size)
+            state[y][x] = letter
+        return state
+
+    def reset(self, rng: random.Random | None = None) -> None:
+        """
+        Sets up a new game with a new snake and apples.
+
+        Args:
+            rng (random.Random | None): Source of the placements, e.g. from
+                `game_rng`; the `random` module by default.
+        """
+        self.cells.clear()
+        self.rows.clear()
+        self.columns.clear()
+        self.snake_position.clear()
+        self.hash = 0
+        self.rng = rng or random
+        self.duration = 0
+        self.dirty = []
+        self._initialize_snake()
+        self._set_apple(2, 'G')
+        self._set_apple(1, 'R')
+        self.dirty = None
+        self.version += 1
+
+    def move(self, p: Position) -> str:
+        """
+        Moves the snake head to the new cell and adjusts the environment
+        to the required state.
+
+        Args:
+            p (Position): The new position of the snake's head.
+
+        Returns:
+            str: The cell type where the snake's head landed.
+        """
+        self.dirty = []
+        snake = self.snake_position
+        letter = self._letter(p.x, p.y)
+        if letter in ['W', 'S'] or (letter == 'R' and len(snake) == 1):
+            self.step.state = GameState.LOST
+        else:
+            if letter in ['0', 'R']:
+                self._pop_tail()
+            if letter == 'R':
+                self._pop_tail()
+                self._set_apple(1, 'R')
+            elif letter == 'G':
+                self._set_apple(1, 'G')
+            snake.appendleft(p)
+            self._set_cell(p.x, p.y, 'H')
+            if len(snake) > 1:
+                self._set_cell(*snake[1], 'S')
+                self._link(snake[1], p)
+        self.duration += 1
+        self.version += 1
+        return letter
+
+    def view(self, universal: bool = False) -> dict:
+        """
+        Returns the rays from the head to the walls, the same strings as
+        `Environment.view`, built from the occupied cells of the row and
+        column of the head.
+
+        Args:
+            universal (bool): Whether runs of the same cell type are
+                collapsed into one cell.
+
+        Returns:
+            dict: {Action: ray} for every direction.
+        """
+        x, y = self.snake_position[0]
+        size = self.size
+        xs = self.rows[y]
+        ys = self.columns[x]
+        i, j = bisect_left(xs, x), bisect_left(ys, y)
+        return {
+            Action.UP: self._ray(ys[j - 1::-1] if j else (), y, -1,
+                                 x, size, universal),
+            Action.DOWN: self._ray(ys[j + 1:], y, size, x, size, universal),
+            Action.LEFT: self._ray(xs[i - 1::-1] if i else (), x, -1,
+                                   y * size, 1, universal),
+            Action.RIGHT: self._ray(xs[i + 1:], x, size, y * size, 1,
+                                    universal),
+        }
+
+    def print_env(self) -> None:
+        """
+        Prints the current state of the environment.
+        """
+        for row in self.state:
+            print(' '.join(row))
+
+    def _ray(self, occupied, start: int, end: int, base: int, stride: int,
+             universal: bool) -> str:
+        """
+        Spells a ray along a row or column.
+
+        Args:
+            occupied (Iterable[int]): Coordinates of the occupied cells
+                met along the ray, in order.
+            start (int): Coordinate of the head.
+            end (int): Coordinate just past the wall, -1 or `size`.
+            base (int): Cell index of coordinate 0 of the line.
+            stride (int): Difference of cell index between two coordinates.
+            universal (bool): Whether runs are collapsed.
+        """
+        cells = self.cells
+        parts = []
+        last = start
+        for c in occupied:
+            gap = abs(c - last) - 1
+            if gap:
+                parts.append('0' if universal else '0' * gap)
+            parts.append(cells[base + c * stride])
+            last = c
+        gap = abs(end - last) - 2
+        if gap:
+            parts.append('0' if universal else '0' * gap)
+        parts.append('W')
+        if universal:
+            parts = [p for k, p in enumerate(parts)
+                     if not k or p != parts[k - 1]]
+        return ''.join(parts)
+
+    def _letter(self, x: int, y: int) -> str:
+        letter = self.cells.get(y * self.size + x)
+        if letter:
+            return letter
+        if x in (0, self.size - 1) or y in (0, self.size - 1):
+            return 'W'
+        return '0'
+
+    def _set_cell(self, x: int, y: int, letter: str) -> None:
+        """
+        Writes a cell, keeps the row and column indexes and the hash in
+        sync with it and records it in `dirty`.
+
+        Args:
+            x (int): The x-coordinate of the cell, not on a wall.
+            y (int): The y-coordinate of the cell, not on a wall.
+            letter (str): The new cell type.
+        """
+        i = y * self.size + x
+        self.dirty.append((x, y, letter))
+        old = self.cells.get(i, '0')
+        self.hash ^= _key(i * 16 + CODES[old]) ^ _key(i * 16 + CODES[letter])
+        if letter == '0':
+            del self.cells[i]
+            xs, ys = self.rows[y], self.columns[x]
+            del xs[bisect_left(xs, x)]
+            del ys[bisect_left(ys, y)]
+            return
+        self.cells[i] = letter
+        if old == '0':
+            insort(self.rows.setdefault(y, []), x)
+            insort(self.columns.setdefault(x, []), y)
+
+    def _pop_tail(self) -> None:
+        """
+        Removes the last segment of the snake.
+        """
+        tail = self.snake_position.pop()
+        self._set_cell(tail.x, tail.y, '0')
+        if self.snake_position:
+            self._link(tail, self.snake_position[-1])
+
+    def _link(self, segment: Position, previous: Position) -> None:
+        """
+        Adds the link between a snake segment and the one before it,
+        towards the head, to `hash`, or removes it when it's there.
+        """
+        i = segment.y * self.size + segment.x
+        self.hash ^= _key(i * 16 + 8 + DIRECTIONS[
+            previous.x - segment.x, previous.y - segment.y])
+
+    def _initialize_snake(self) -> None:
+        """
+        Places a snake of three segments in a random straight or bent line.
+        """
+        snake = self.snake_position
+        x, y = self._get_empty_cell()
+        self._set_cell(x, y, 'H')
+        snake.append(Position(x, y))
+        for _ in range(2):
+            while True:
+                x_new, y_new = self.rng.choice([(x, y - 1), (x, y + 1),
+                                                (x - 1, y), (x + 1, y)])
+                if self._letter(x_new, y_new) == '0':
+                    x, y = x_new, y_new
+                    self._set_cell(x, y, 'S')
+                    snake.append(Position(x, y))
+                    self._link(snake[-1], snake[-2])
+                    break
+
+    def _set_apple(self, number: int, color: str) -> None:
+        """
+        Sets apples on the board.
+
+        Args:
+            number (int): Number of apples to set.
+            color (str): Color of the apples ('R' or 'G').
+        """
+        for _ in range(number):
+            x, y = self._get_empty_cell()
+            if self.step.state == GameState.RUNNING:
+                self._set_cell(x, y, color)
+
+    def _get_empty_cell(self) -> Position:
+        """
+        Returns the coordinates of a random empty cell.
+
+        While at least half of the cells are empty, random cells are drawn
+        until one is empty, in two draws on average; otherwise the empty
+        cells are counted to pick one.
+
+        Returns:
+            Position: The coordinates of an empty cell.
+        """
+        inner = self.size - 2
+        free = inner * inner - len(self.cells)
+        if free == 0:
+            print("YOU WON!!!!")
+            self.step.state = GameState.WON
+            return None, None
+        if free * 2 >= inner * inner:
+            while True:
+                x = self.rng.randrange(inner) + 1
+                y = self.rng.randrange(inner) + 1
+                if y * self.size + x not in self.cells:
+                    return Position(x, y)
+        k = self.rng.randrange(free)
+        for y in range(1, self.size - 1):
+            for x in range(1, self.size - 1):
+                if y * self.size + x not in self.cells:
+                    if not k:
+                        return Position(x, y)
+                    k -= 1
+
+
+def check_views(sizes=(5, 7, 12, 30), games: int = 300, seed: int = 0
+                ) -> int:
+    """
+    Plays random games and compares every view with the rays read from
+    the dense `state`, as `Environment.view` reads them.
+
+    Returns:
+        int: The number of views that differ.
+    """
+    moves = [Movement.move_up, Movement.move_down, Movement.move_left,
+             Movement.move_right]
+    mismatches = 0
+    for size in sizes:
+        settings = Settings(boardsize=size - 2, env_size=size)
+        step = Step()
+        env = SparseEnvironment(settings, step)
+        for game in range(games):
+            step.state = GameState.RUNNING
+            env.reset(random.Random(f'{seed}:{size}:{game}'))
+            rng = random.Random(f'{seed}:{size}:{game}:moves')
+            while step.state == GameState.RUNNING and env.duration < 400:
+                state = env.state
+                x, y = env.snake_position[0]
+                row = ''.join(state[y])
+                column = ''.join(r[x] for r in state)
+                rays = {Action.UP: column[y-1::-1],
+                        Action.DOWN: column[y + 1:],
+                        Action.LEFT: row[x-1::-1],
+                        Action.RIGHT: row[x + 1:]}
+                mismatches += env.view() != rays
+                mismatches += env.view(True) != {
+                    a: squash(ray) for a, ray in rays.items()}
+                targets = [move(env.snake_position[0]) for move in moves]
+                safe = [p for p in targets if state[p.y][p.x] not in 'WS']
+                env.move(rng.choice(safe or targets))
+    return mismatches
+
+
+if __name__ == "__main__":
+    mismatches = check_views()
+    print(f'{mismatches} views differ from the dense rays')
+    raise SystemExit(1 if mismatches else 0)
@@ -1,6 +1,9 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
 from enum import Enum
 import logging
+import os
+import random
+import tempfile
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
@@ -9,25 +12,113 @@ CELL = 50
 BOARD_SIZE = 10
 LIMIT_DURATION = 1000
 SESSIONS = 200
+# The umask of the process, read once at import: reading it means setting
+# it, which would race with files created by other threads.
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 Position = namedtuple('Position', ['x', 'y'])
 
 
 class Settings:
-    sessions = SESSIONS
-    boardsize = BOARD_SIZE
-    env_size = BOARD_SIZE + 2  # Walls on each of the sides
-    delay = 0.2
-    save_path = None
-    load_path = None
-    epochs = None
-    visual = False
-    exploit = False
-    dontlearn = False
-    step_by_step = False
-    manual = False
-    universal = False
-    seed = None
+    """
+    The configuration of a run.
+
+    Every game engine object gets the settings it works with explicitly,
+    so several runs with different settings can live in one process.
+
+    Attributes:
+        sessions (int): The number of sessions (games) to perform.
+        boardsize (int): The size of the game board.
+        env_size (int): The size of the game environment including walls.
+        delay (float): Pause between two moves in visual mode, in seconds.
+        fps (int): If set, visual mode plays at full speed and draws at
+            most this many frames per second instead of pausing; also the
+            frame rate of manual mode.
+        render_every (int): With `fps`, only every given game is drawn.
+        save_path (str): The path where the model (q-table) will be saved.
+        load_path (str | list): The path(s) where the model (q-table) will
+            be loaded from.
+        epochs (int): The number of training epochs.
+        visual (bool): If True, display training progress.
+        exploit (bool): If True, the model doesn't explore.
+        dontlearn (bool): If True, the model won't update q-table.
+        step_by_step (bool): If True, the model will wait for user input
+            after each move.
+        manual (bool): If True, play the game manually.
+        universal (bool): If True, use the board size independent view.
+        sparse (bool): If True, play on a `SparseEnvironment`, for boards
+            too large to store as a grid.
+        seed (int): Seed for the random number generator.
+        workers (int): The number of processes to train or evaluate with.
+        headless (bool): If True, don't listen to the keyboard and don't
+            plot the statistics.
+        checkpoint_every (int): Save the model every given number of
+            sessions; 0 to disable.
+        checkpoint (str): The path of the resumable training checkpoint.
+        incremental (bool): Whether models saved after every epoch but the
+            first only hold the changes since the previous one.
+        detect_cycles (bool): Whether frozen models that always exploit
+            have their looping games ended as breaks as soon as the loop
+            closes, instead of at `LIMIT_DURATION`.
+        greedy (bool): Whether frozen models (`dontlearn`) are played by a
+            `GreedyAgent`.
+        replay (int): Capacity of the experience replay buffer; 0 to learn
+            from every transition only once.
+        replay_batch (int): Number of transitions replayed at a time.
+        replay_every (int): Number of moves between two replays.
+        prioritized (bool): Whether transitions are replayed in proportion
+            to their TD error instead of uniformly.
+        prune_visits (int): States visited fewer times are dropped from the
+            Q-table after every epoch; 0 to disable.
+        prune_value (float): States with a lower absolute Q-value are
+            dropped from the Q-table after every epoch; 0 to disable.
+        profile (bool): If True, time the phases of the game loop.
+        cprofile (str): The path to dump cProfile data to.
+    """
+    def __init__(self, **settings) -> None:
+        self.sessions = SESSIONS
+        self.boardsize = BOARD_SIZE
+        self.env_size = BOARD_SIZE + 2  # Walls on each of the sides
+        self.delay = 0.2
+        self.fps = 0
+        self.render_every = 1
+        self.save_path = None
+        self.load_path = None
+        self.epochs = None
+        self.visual = False
+        self.exploit = False
+        self.dontlearn = False
+        self.step_by_step = False
+        self.manual = False
+        self.universal = False
+        self.sparse = False
+        self.seed = None
+        self.workers = 1
+        self.headless = False
+        self.checkpoint_every = 0
+        self.checkpoint = None
+        self.incremental = False
+        self.detect_cycles = True
+        self.greedy = False
+        self.replay = 0
+        self.replay_batch = 8
+        self.replay_every = 1
+        self.prioritized = False
+        self.prune_visits = 0
+        self.prune_value = 0.0
+        self.profile = False
+        self.cprofile = None
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise TypeError(f'Unknown setting: {name}')
+            setattr(self, name, value)
+
+    def replace(self, **changes) -> 'Settings':
+        """
+        Returns a copy of the settings with some of the values changed.
+        """
+        return Settings(**{**vars(self), **changes})
 
 
 class Action(Enum):
@@ -72,59 +163,108 @@ class GameState(Enum):
 
 class Step:
     """
-    A class to represent the game state and round.
+    The state of the current game and the records of the current tenth of
+    the sessions.
 
     Attributes:
-        round (int): The current round of the game.
         state (GameState): The current state of the game.
         not_ten (int): The number of rounds where the snake length was less
             than 10.
         max_duration (int): The maximum duration of a round.
         max_length (int): The maximum length of the snake.
-        sessions (int): The number of Settings.sessions to perform.
-        boardsize (int): The size of the game board.
-        env_size (int): The size of the game environment including walls.
-        save_path (str): The path where the model (q-table) will be saved.
-        load_path (str): The path where the model (q-table) will be
-            loaded from.
-        visual (bool): If True, display training progress.
-        dontlearn (bool): If True, the model won't update q-table.
-        step_by_step (bool): If True, the model will wait for user input
-            after each move.
-        manual (bool): If True, play the Settings.manually.
+        max_break (int): The number of rounds stopped after
+            `LIMIT_DURATION` moves.
     """
-    state = GameState.RUNNING
-    not_ten = 0
-    max_duration = 0
-    max_length = 0
-    max_break = 0
+    def __init__(self) -> None:
+        self.reset_stats()
 
-    def reset_stats():
-        Step.state = GameState.RUNNING
-        Step.not_ten = 0
-        Step.max_duration = 0
-        Step.max_length = 0
-        Step.max_break = 0
+    def reset_stats(self) -> None:
+        self.state = GameState.RUNNING
+        self.not_ten = 0
+        self.max_duration = 0
+        self.max_length = 0
+        self.max_break = 0
 
 
 class Stats:
-    round = 0
-    max_length = []
-    all_lengths = []
-    breaks = 0
-    not_ten = 0
+    """
+    The statistics of a run.
 
-    def update_stats():
-        Stats.max_length.append(Step.max_length)
-        Stats.breaks += Step.max_break
-        Stats.not_ten += Step.not_ten
+    Final snake lengths are aggregated as they come in: a histogram of
+    lengths, their sum and their maximum. Lengths are bounded by the board
+    area, so memory doesn't grow with the number of sessions while the
+    mean and the median stay exact.
 
-    def reset_stats():
-        Stats.round = 0
-        Stats.max_length = []
-        Stats.all_lengths = []
-        Stats.breaks = 0
-        Stats.not_ten = 0
+    Attributes:
+        round (int): The number of finished rounds.
+        max_length (list[int]): The maximum length of every tenth of the
+            sessions.
+        lengths (Counter): The number of rounds per final snake length.
+        length_sum (int): The sum of the final lengths of all rounds.
+        longest (int): The longest final length of all rounds.
+        breaks (int): The number of rounds stopped after `LIMIT_DURATION`
+            moves.
+        not_ten (int): The number of rounds where the snake length was less
+            than 10.
+    """
+    def __init__(self) -> None:
+        self.reset_stats()
+
+    def add_length(self, length: int) -> None:
+        self.lengths[length] += 1
+        self.length_sum += length
+        if length > self.longest:
+            self.longest = length
+
+    def count(self) -> int:
+        return self.lengths.total()
+
+    def mean(self) -> float:
+        return self.length_sum / self.count()
+
+    def median(self) -> float:
+        """
+        Returns the median final length, as `statistics.median` would over
+        the list of all lengths.
+        """
+        count = self.count()
+        middle = [(count - 1) // 2, count // 2]
+        values = []
+        seen = 0
+        for length in sorted(self.lengths):
+            seen += self.lengths[length]
+            while middle and middle[0] < seen:
+                values.append(length)
+                middle.pop(0)
+        return values[0] if values[0] == values[1] else sum(values) / 2
+
+    def update_stats(self, step: Step) -> None:
+        self.max_length.append(step.max_length)
+        self.breaks += step.max_break
+        self.not_ten += step.not_ten
+
+    def snapshot(self) -> 'Stats':
+        stats = Stats()
+        stats.merge(self)
+        return stats
+
+    def merge(self, stats: 'Stats') -> None:
+        self.round += stats.round
+        self.max_length.extend(stats.max_length)
+        self.lengths.update(stats.lengths)
+        self.length_sum += stats.length_sum
+        self.longest = max(self.longest, stats.longest)
+        self.breaks += stats.breaks
+        self.not_ten += stats.not_ten
+
+    def reset_stats(self) -> None:
+        self.round = 0
+        self.max_length = []
+        self.lengths = Counter()
+        self.length_sum = 0
+        self.longest = 0
+        self.breaks = 0
+        self.not_ten = 0
 
 
 class Movement:
@@ -160,3 +300,55 @@ class Movement:
     @staticmethod
     def move_right(p: Position) -> Position:
         return Position(p.x + 1, p.y)
+
+
+def game_rng(seed, stream: str, game: int) -> random.Random:
+    """
+    Returns the random generator of one component for one game.
+
+    Every component draws from its own stream, derived from the seed of
+    the run, the name of the stream and the index of the game, so the
+    apples of a game don't depend on how many draws the agent made, and
+    any game can be played again on its own. Without a seed the stream is
+    seeded from the `random` module.
+
+    Args:
+        seed (int | str | None): The seed of the run.
+        stream (str): The component, e.g. 'env' or 'agent'.
+        game (int): The index of the game in the run.
+
+    Returns:
+        random.Random: The generator.
+    """
+    if seed is None:
+        return random.Random(random.getrandbits(64))
+    return random.Random(f'{seed}:{stream}:{game}')
+
+
+def atomic_write(path: str, data) -> None:
+    """
+    Writes a file so that readers see either the old or the new content
+    in full: the data goes to a temporary file in the same directory,
+    which then replaces the target.
+
+    Args:
+        path (str): The path of the file.
+        data (bytes | Iterable[bytes]): The new content, whole or in parts.
+    """
+    if isinstance(data, bytes):
+        data = [data]
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp creates the file private; give it the usual mode.
+            os.chmod(f.fileno(), 0o666 & ~UMASK)
+            for part in data:
+                f.write(part)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
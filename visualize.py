@@ -14,77 +14,223 @@ from utils import (
 )
 
 
+# Colors of the cells drawn as squares and of the apples.
+SQUARES = {'W': 'grey', 'H': (35, 35, 150), 'S': (35, 100, 255)}
+APPLES = {'G': 'green', 'R': 'red'}
+BACKGROUND = (25, 25, 25)
+# Frame rate of manual mode, which only needs to keep up with key presses.
+MANUAL_FPS = 30
+
+
+class RenderScheduler:
+    """
+    Paces the frames of a visual run that plays at full speed: a frame is
+    due at most `fps` times per second, and the steps in between are
+    played without being drawn.
+
+    Attributes:
+        interval (float): Minimum time between two frames, in seconds.
+        next_frame (float): `time.perf_counter()` time of the next frame.
+    """
+    def __init__(self, fps: float) -> None:
+        self.interval = 1 / fps
+        self.next_frame = 0.0
+
+    def due(self) -> bool:
+        """
+        Returns whether a frame should be drawn now, and if so schedules
+        the next one.
+        """
+        now = time.perf_counter()
+        if now < self.next_frame:
+            return False
+        self.next_frame = now + self.interval
+        return True
+
+
 class Visualize:
-    def __init__(self) -> None:
+    """
+    Draws the board and the statistics in a pygame window.
+
+    Drawing is retained: the background with the walls and the grid is
+    drawn once, the text of a statistic is rendered again only when it
+    changes, and a frame only redraws the cells that changed since the
+    last one and updates their rectangles on the screen.
+
+    When the board moved once since the last frame, the changed cells are
+    the ones in its `dirty` list; after a reset or frames that were not
+    drawn, the whole board is compared with the cells as last drawn.
+
+    Attributes:
+        background (pygame.Surface): The window with the walls and the grid
+            and nothing else.
+        drawn (list | None): The cells as last drawn, or None when the
+            next frame redraws the whole window.
+        board (tuple | None): The board as last drawn and its `version`.
+        texts (dict): {line: text} of the statistics as last drawn.
+    """
+    def __init__(self, settings: Settings, stats: Stats | None = None
+                 ) -> None:
         pygame.init()
-        self.playfield = max(Settings.env_size, BOARD_SIZE + 2)
+        self.settings = settings
+        self.stats = stats or Stats()
+        self.playfield = max(settings.env_size, BOARD_SIZE + 2)
         self.window_width = self.playfield * CELL + 400
         self.window_height = self.playfield * CELL
         self.window = pygame.display.set_mode((self.window_width,
                                                self.window_height))
         pygame.display.set_caption("Learn2Slither")
+        self.font = pygame.font.SysFont('freesans', 25)
+        self.background = self._draw_background()
+        self.drawn = None
+        self.board = None
+        self.texts = {}
+
+    def invalidate(self) -> None:
+        """
+        Makes the next frame redraw the whole window, e.g. after something
+        else was drawn over it.
+        """
+        self.drawn = None
 
     def draw_state(self, env: Environment, exploitation_rate=None) -> None:
-        self.window.fill((25, 25, 25))
-
-        def draw_rect(x, y, color):
-            pygame.draw.rect(self.window, color, (x * CELL, y * CELL,
-                                                  CELL, CELL))
-
-        def draw_circle(x, y, color):
-            pygame.draw.circle(self.window, color, (x * CELL + CELL / 2,
-                                                    y * CELL + CELL / 2), 20)
-
-        def draw_board():
-            for i in range(Settings.boardsize + 1):
-                iterate = CELL * i + CELL
-                pygame.draw.line(self.window,
-                                 "white",
-                                 (CELL, iterate),
-                                 (CELL * Settings.boardsize + CELL, iterate),
-                                 2)
-                pygame.draw.line(self.window,
-                                 "white",
-                                 (iterate, CELL),
-                                 (iterate, CELL * Settings.boardsize + CELL),
-                                 2)
-
-        def draw_stats():
-            font = pygame.font.SysFont('freesans', 25)
-            info = [f'Rounds: {Stats.round}',
-                    f'Current length: {len(env.snake_position)}',
-                    f'Maximum length: {max(Stats.all_lengths)}'
-                    if Stats.all_lengths else '',
-                    f'Exploitation rate: {exploitation_rate:.2f}'
-                    if exploitation_rate is not None else '',
-                    f'Current speed: {1 / Settings.delay:.1f} cells/s'
-                    if not Settings.step_by_step and not Settings.manual
-                    else '',
-                    'Press SPACE to continue' if Settings.step_by_step
-                    else '',
-                    ]
-            for i in range(len(info)):
-                text = font.render(info[i], False, (255, 255, 255))
-                self.window.blit(text, (self.playfield * CELL + 20,
-                                        i * 50 + 20))
-
-        for i, array in enumerate(env.state):
-            for j, value in enumerate(array):
-                if value == 'W':
-                    draw_rect(j, i, "grey")
-                elif value == 'H':
-                    draw_rect(j, i, (35, 35, 150))
-                elif value == 'S':
-                    draw_rect(j, i, (35, 100, 255))
-                elif value == 'G':
-                    draw_circle(j, i, "green")
-                elif value == 'R':
-                    draw_circle(j, i, "red")
-                elif value == '0':
-                    pass
-        draw_board()
-        draw_stats()
-        pygame.display.update()
+        if self.drawn is None:
+            self.window.blit(self.background, (0, 0))
+            size = self.settings.env_size
+            self.drawn = [['W' if x in (0, size - 1) or y in (0, size - 1)
+                           else '0' for x in range(size)]
+                          for y in range(size)]
+            self.board = None
+            self.texts = {}
+            rects = None
+        else:
+            rects = []
+        if self.board == (env, env.version - 1) and env.dirty is not None:
+            changes = {(x, y): value for x, y, value in env.dirty}.items()
+        elif self.board == (env, env.version):
+            changes = ()
+        else:
+            changes = self._diff(env.state)
+        drawn = self.drawn
+        for (x, y), value in changes:
+            if drawn[y][x] != value:
+                drawn[y][x] = value
+                rect = self._draw_cell(x, y, value)
+                if rects is not None:
+                    rects.append(rect)
+        self.board = (env, env.version)
+        for rect in self._draw_stats(env, exploitation_rate):
+            if rects is not None:
+                rects.append(rect)
+        if rects is None:
+            pygame.display.update()
+        elif rects:
+            pygame.display.update(rects)
+
+    def _diff(self, state: list) -> list:
+        """
+        Compares a whole board with the cells as last drawn.
+
+        Returns:
+            list: ((x, y), letter) of every cell that differs.
+        """
+        changes = []
+        for y, (row, drawn) in enumerate(zip(state, self.drawn)):
+            if row != drawn:
+                changes.extend(((x, y), value) for x, (value, old)
+                               in enumerate(zip(row, drawn)) if value != old)
+        return changes
+
+    def _draw_background(self) -> pygame.Surface:
+        """
+        Draws the empty board: the walls and the grid.
+        """
+        background = pygame.Surface(self.window.get_size())
+        background.fill(BACKGROUND)
+        size = self.settings.env_size
+        for y in range(size):
+            for x in range(size):
+                if x in (0, size - 1) or y in (0, size - 1):
+                    pygame.draw.rect(background, SQUARES['W'],
+                                     (x * CELL, y * CELL, CELL, CELL))
+        self._draw_grid(background)
+        return background
+
+    def _draw_grid(self, surface: pygame.Surface, lines=None) -> None:
+        """
+        Draws the lines of the grid, all of them or only the given ones.
+
+        Args:
+            surface (pygame.Surface): Where to draw.
+            lines (Iterable[int] | None): Indices of the horizontal and
+                vertical lines to draw, from 0 to `boardsize`.
+        """
+        boardsize = self.settings.boardsize
+        for i in range(boardsize + 1) if lines is None else lines:
+            iterate = CELL * i + CELL
+            pygame.draw.line(surface,
+                             "white",
+                             (CELL, iterate),
+                             (CELL * boardsize + CELL, iterate),
+                             2)
+            pygame.draw.line(surface,
+                             "white",
+                             (iterate, CELL),
+                             (iterate, CELL * boardsize + CELL),
+                             2)
+
+    def _draw_cell(self, x: int, y: int, value: str) -> pygame.Rect:
+        """
+        Redraws a cell over the background, with the grid on top. Only
+        the lines along the edges of the cell can reach into it.
+
+        Returns:
+            pygame.Rect: The area of the window that changed.
+        """
+        rect = pygame.Rect(x * CELL, y * CELL, CELL, CELL)
+        self.window.set_clip(rect)
+        self.window.blit(self.background, rect, rect)
+        if value in SQUARES:
+            pygame.draw.rect(self.window, SQUARES[value], rect)
+        elif value in APPLES:
+            pygame.draw.circle(self.window, APPLES[value],
+                               (x * CELL + CELL / 2, y * CELL + CELL / 2), 20)
+        self._draw_grid(self.window, {i for i in (x - 1, x, y - 1, y)
+                                      if 0 <= i <= self.settings.boardsize})
+        self.window.set_clip(None)
+        return rect
+
+    def _draw_stats(self, env: Environment, exploitation_rate) -> list:
+        """
+        Redraws the lines of statistics whose text changed.
+
+        Returns:
+            list[pygame.Rect]: The areas of the window that changed.
+        """
+        settings = self.settings
+        info = [f'Rounds: {self.stats.round}',
+                f'Current length: {len(env.snake_position)}',
+                f'Maximum length: {self.stats.longest}'
+                if self.stats.round else '',
+                f'Exploitation rate: {exploitation_rate:.2f}'
+                if exploitation_rate is not None else '',
+                f'Current speed: {1 / settings.delay:.1f} cells/s'
+                if not (settings.step_by_step or settings.manual
+                        or settings.fps) else '',
+                'Press SPACE to continue' if settings.step_by_step
+                else '',
+                ]
+        rects = []
+        for i, line in enumerate(info):
+            if self.texts.get(i) == line:
+                continue
+            self.texts[i] = line
+            rect = pygame.Rect(self.playfield * CELL, i * 50 + 20, 400, 50)
+            self.window.fill(BACKGROUND, rect)
+            text = self.font.render(line, False, (255, 255, 255))
+            self.window.blit(text, (self.playfield * CELL + 20, i * 50 + 20))
+            rects.append(rect)
+        return rects
 
     def catch_key_event(self) -> KeyEvent | None:
         """
@@ -106,7 +252,10 @@ class Visualize:
         """
         Runs the game loop, handling events and updating the game state.
         """
-        env = Environment()
+        step = Step()
+        env = Environment(self.settings, step)
+        font = pygame.font.Font('Decay-M5RB.ttf', 50)
+        clock = pygame.time.Clock()
         running = True
         while running:
             for event in pygame.event.get():
@@ -128,29 +277,27 @@ class Visualize:
                       and event.key == pygame.K_DOWN):
                     env.move(Movement.move_down(env.snake_position[0]))
 
-            if Step.state != GameState.RUNNING:
-                self.window.fill((25, 25, 25))
+            if step.state != GameState.RUNNING:
                 self.draw_state(env)
-                font = pygame.font.Font('Decay-M5RB.ttf', 50)
-                phrase = ('You won!' if Step.state == GameState.WON
+                phrase = ('You won!' if step.state == GameState.WON
                           else 'Game Over!')
                 text = font.render(phrase, False, (255, 0, 0))
                 self.window.blit(text, (100, 250))
                 pygame.display.update()
+                self.invalidate()
                 time.sleep(1)
-                Stats.round += 1
-                Stats.all_lengths.append(len(env.snake_position))
-                Step.state = GameState.RUNNING
-                env = Environment()
+                self.stats.round += 1
+                self.stats.add_length(len(env.snake_position))
+                step.state = GameState.RUNNING
+                env.reset()
 
             self.draw_state(env)
-
-            pygame.display.update()
+            clock.tick(self.settings.fps or MANUAL_FPS)
 
         pygame.quit()
 
 
 if __name__ == "__main__":
     random.seed(42)
-    play = Visualize()
+    play = Visualize(Settings(manual=True))
     play.run()
@@ -0,0 +1,77 @@
+import queue
+import threading
+
+from utils import atomic_write
+
+# Number of pending writes after which `BackgroundWriter.submit` waits.
+MAX_PENDING = 2
+
+
+class BackgroundWriter:
+    """
+    Writes files from a background thread so that training doesn't wait
+    for the serialization of large Q-tables.
+
+    The caller hands over a snapshot that the game loop no longer changes,
+    e.g. `QTable.snapshot()`, which only copies the arrays, and a function
+    that encodes it; the encoding and the atomic write happen in the thread.
+    The queue is bounded: when `MAX_PENDING` writes are waiting, `submit`
+    blocks until the oldest one is done instead of piling up snapshots.
+
+    Methods:
+        submit(path: str, encode: callable, message: str | None) -> None:
+            Queues a write of the parts returned by `encode()` to `path`.
+        flush() -> None:
+            Waits until every queued write is done.
+        close() -> None:
+            Flushes and stops the thread.
+    """
+    def __init__(self, max_pending: int = MAX_PENDING) -> None:
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run,
+                                        name='BackgroundWriter')
+        self._thread.start()
+
+    def __enter__(self) -> 'BackgroundWriter':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def submit(self, path: str, encode, message: str | None = None) -> None:
+        """
+        Queues a write.
+
+        Args:
+            path (str): The path of the file.
+            encode (callable): Returns the content as bytes or an iterable
+                of bytes; called in the writer thread.
+            message (str | None): Printed once the file is written.
+        """
+        if not self._thread.is_alive():
+            raise RuntimeError('The writer is closed')
+        self._queue.put((path, encode, message))
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                path, encode, message = job
+                try:
+                    atomic_write(path, encode())
+                    if message:
+                        print(message)
+                except Exception as e:
+                    print(f'Error saving {path}: {e}')
+            finally:
+                self._queue.task_done()